@@ -0,0 +1,336 @@
+import signal
+import socketserver
+import threading
+import time
+from dataclasses import asdict, dataclass
+import db
+import queue_ctl
+from daemon import EnqueueBatcher, RequestHandler
+from model import HostCapacity, Job, RunUsage
+
+# leases not renewed by a heartbeat within this many seconds are reclaimed
+LEASE_TIMEOUT = 30.0
+
+# upper bound on jobs leased by one claim
+MAX_PREFETCH = 100
+
+
+@dataclass
+class Lease:
+    job: Job
+    worker_id: str
+    host: str
+    deadline: float  # time.monotonic()
+    started: bool = False  # the worker reported running it
+
+
+class LeaseTable:
+    """
+    Jobs handed out to remote workers.
+
+    Claims run under one lock, so admission for a host sees every lease
+    already handed to that host. The jobs stay 'processing' in the database
+    until they are acked, nacked, released or their lease expires.
+    """
+
+    def __init__(self, lease_timeout: float = LEASE_TIMEOUT):
+        self.lease_timeout = lease_timeout
+        self.leases: dict[str, Lease] = {}
+        self.lock = threading.Lock()
+
+    def reserved(self, host: str) -> tuple[float, int]:
+        """cpus and memory_mb declared by the jobs leased to one host."""
+        leases = [lease for lease in self.leases.values() if lease.host == host]
+        return (
+            sum(lease.job.cpus or 0 for lease in leases),
+            sum(lease.job.memory_mb or 0 for lease in leases),
+        )
+
+    def claim(
+        self,
+        worker_id: str,
+        host: str,
+        count: int,
+        capacity: HostCapacity | None,
+        start: bool = False,
+    ) -> list[Job]:
+        """lease up to count jobs, with start the first one is marked started."""
+        jobs = []
+
+        with self.lock:
+            while len(jobs) < count:
+                job = queue_ctl.fetch_job_atomically(
+                    db.shard_for_job(worker_id),
+                    worker_id,
+                    capacity,
+                    self.reserved(host) if capacity is not None else None,
+                    host,
+                )
+
+                if job is None:
+                    break
+
+                if job.cache_key is not None and queue_ctl.complete_from_cache(job):
+                    continue
+
+                self.leases[job.id] = Lease(
+                    job,
+                    worker_id,
+                    host,
+                    time.monotonic() + self.lease_timeout,
+                    started=start and not jobs,
+                )
+                jobs.append(job)
+
+        return jobs
+
+    def take(self, worker_id: str, job_id: str) -> Job:
+        """remove the lease of a finished job. Raises ValueError when it is not the worker's."""
+        with self.lock:
+            lease = self.leases.get(job_id)
+
+            if lease is None or lease.worker_id != worker_id:
+                raise ValueError(
+                    f"{worker_id} holds no lease on job {job_id}, it expired."
+                )
+
+            del self.leases[job_id]
+
+        return lease.job
+
+    def start(self, worker_id: str, job_id: str) -> bool:
+        """
+        Mark a lease started before the worker runs the job, so a job that
+        kills its worker is counted as an attempt when the lease expires.
+        False when the worker no longer holds the lease.
+        """
+        with self.lock:
+            lease = self.leases.get(job_id)
+
+            if lease is None or lease.worker_id != worker_id:
+                return False
+
+            lease.started = True
+            lease.deadline = time.monotonic() + self.lease_timeout
+
+        return True
+
+    def renew(
+        self, worker_id: str, job_ids: list[str], running: str | None = None
+    ) -> list[str]:
+        """extend a worker's leases, returns the job ids it no longer holds."""
+        deadline = time.monotonic() + self.lease_timeout
+        lost = []
+
+        with self.lock:
+            for job_id in job_ids:
+                lease = self.leases.get(job_id)
+
+                if lease is None or lease.worker_id != worker_id:
+                    lost.append(job_id)
+                    continue
+
+                lease.deadline = deadline
+                lease.started = lease.started or job_id == running
+
+        return lost
+
+    def expired(self, now: float | None = None) -> list[Lease]:
+        """remove and return the leases past their deadline."""
+        now = time.monotonic() if now is None else now
+
+        with self.lock:
+            gone = [lease for lease in self.leases.values() if lease.deadline < now]
+
+            for lease in gone:
+                del self.leases[lease.job.id]
+
+        return gone
+
+
+def _run_result(request: dict) -> dict:
+    """update_job_state/fail_job keyword arguments from an ack or nack."""
+    usage = request.get("usage")
+    output = request.get("output")
+    item_results = request.get("item_results")
+
+    return {
+        "usage": RunUsage(**usage) if usage else None,
+        "output": tuple(output) if output is not None else None,
+        # JSON object keys are strings
+        "item_results": (
+            {int(idx): code for idx, code in item_results.items()}
+            if item_results
+            else None
+        ),
+    }
+
+
+class BrokerHandler(RequestHandler):
+    """the worker RPCs, every other op is served like the local daemon."""
+
+    def dispatch(self, request: dict):
+        op = request.get("op")
+        leases = self.server.leases
+        worker_id = request.get("worker_id")
+
+        if op == "hello":
+            config = self.server.config
+            return {
+                key: config[key] for key in ("max_retries", "backoff_base", "job_timeout")
+            }
+
+        if op == "claim":
+            prefetch = min(max(int(request.get("prefetch") or 1), 1), MAX_PREFETCH)
+            capacity = request.get("capacity")
+            jobs = leases.claim(
+                worker_id,
+                request.get("host") or worker_id,
+                prefetch,
+                HostCapacity(**capacity) if capacity else None,
+                bool(request.get("start")),
+            )
+            return [self._job_message(job) for job in jobs]
+
+        if op == "start":
+            return {"held": leases.start(worker_id, request.get("job_id"))}
+
+        if op == "ack":
+            job = leases.take(worker_id, request.get("job_id"))
+            queue_ctl.update_job_state(
+                job.id,
+                "completed",
+                shard=job.shard,
+                cache_key=job.cache_key,
+                **_run_result(request),
+            )
+            return {"held": self._start_next(request)}
+
+        if op == "nack":
+            job = leases.take(worker_id, request.get("job_id"))
+            delay = queue_ctl.fail_job(
+                job, self.server.config["backoff_base"], **_run_result(request)
+            )
+            return {"delay": delay, "held": self._start_next(request)}
+
+        if op == "heartbeat":
+            return {
+                "lost": leases.renew(
+                    worker_id, request.get("job_ids") or [], request.get("running")
+                )
+            }
+
+        if op == "release":
+            released = 0
+
+            for job_id in request.get("job_ids") or []:
+                try:
+                    job = leases.take(worker_id, job_id)
+
+                except ValueError:
+                    continue
+
+                queue_ctl.requeue_interrupted_job(job.id, job.attempts, job.shard)
+                released += 1
+
+            return {"count": released}
+
+        return super().dispatch(request)
+
+    def _start_next(self, request: dict) -> bool | None:
+        """start the next job along with an ack or nack, None when there is none."""
+        job_id = request.get("start")
+
+        if job_id is None:
+            return None
+
+        return self.server.leases.start(request.get("worker_id"), job_id)
+
+    @staticmethod
+    def _job_message(job: Job) -> dict:
+        """the job with everything a worker without the database needs to run it."""
+        payload = queue_ctl.load_payload(job)
+        items = queue_ctl.load_map_items(job) if job.parent_id is not None else None
+
+        return {
+            "job": asdict(job),
+            "payload": asdict(payload) if payload is not None else None,
+            "items": items,
+        }
+
+
+class BrokerServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(
+        self, address: tuple[str, int], config: dict, lease_timeout: float = LEASE_TIMEOUT
+    ):
+        self.config = config
+        self.leases = LeaseTable(lease_timeout)
+        self.batcher = EnqueueBatcher()
+        self.stopped = threading.Event()
+        super().__init__(address, BrokerHandler)
+
+    def reap_expired(self, interval: float = 1.0):
+        """
+        Reclaim jobs of workers that stopped heartbeating. A job the worker
+        had started counts as a failed attempt, so a job that kills its
+        worker still ends in the DLQ. Prefetched jobs go back unchanged.
+        """
+        try:
+            while not self.stopped.wait(interval):
+                for lease in self.leases.expired():
+                    job = lease.job
+
+                    if lease.started:
+                        queue_ctl.fail_job(job, self.config["backoff_base"])
+
+                    else:
+                        queue_ctl.requeue_interrupted_job(job.id, job.attempts, job.shard)
+
+        finally:
+            db.close_conn()
+
+
+def serve(
+    host: str,
+    port: int,
+    lease_timeout: float = LEASE_TIMEOUT,
+    on_ready=None,
+):
+    """run the broker in the foreground until SIGTERM/SIGINT."""
+    db.init_db()
+    config = db.load_config()
+    db.close_conn()
+
+    server = BrokerServer((host, port), config, lease_timeout)
+    reaper = threading.Thread(target=server.reap_expired, daemon=True)
+    reaper.start()
+
+    def shutdown(signum, frame):
+        # shutdown() blocks until serve_forever returns, so call it off-thread
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    if on_ready is not None:
+        on_ready(server.server_address)
+
+    try:
+        server.serve_forever()
+
+    finally:
+        server.stopped.set()
+        reaper.join()
+        server.server_close()
+        server.batcher.stop()
+
+        # nobody can ack them anymore, put every leased job back in the queue
+        for lease in server.leases.expired(float("inf")):
+            queue_ctl.requeue_interrupted_job(
+                lease.job.id, lease.job.attempts, lease.job.shard
+            )
+
+        db.close_conn()
@@ -0,0 +1,262 @@
+import json
+import os
+import socket
+import struct
+import threading
+from db import APP_DIR
+
+SOCKET_PATH = os.path.join(APP_DIR, "queuectl.sock")
+
+# default TCP port of `queuectl broker`
+BROKER_PORT = 7650
+
+# every message is a 4 byte big-endian length followed by that many bytes of JSON
+_HEADER = struct.Struct(">I")
+MAX_FRAME = 64 * 1024 * 1024
+
+
+class QueueClientError(Exception):
+    """raised when the daemon answers a request with an error."""
+
+
+def parse_address(value: str) -> tuple[str, int]:
+    """'host:port' or a bare host, which uses BROKER_PORT. Raises ValueError."""
+    host, sep, port = value.rpartition(":")
+
+    if not sep:
+        return value, BROKER_PORT
+
+    if not port.isdigit():
+        raise ValueError(f"Invalid broker address '{value}'.")
+
+    return host or "127.0.0.1", int(port)
+
+
+def send_frame(sock: socket.socket, message: dict):
+    body = json.dumps(message, separators=(",", ":")).encode()
+    sock.sendall(_HEADER.pack(len(body)) + body)
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes | None:
+    chunks = []
+
+    while size:
+        chunk = sock.recv(size)
+
+        if not chunk:
+            return None
+
+        chunks.append(chunk)
+        size -= len(chunk)
+
+    return b"".join(chunks)
+
+
+def recv_frame(sock: socket.socket) -> dict | None:
+    """read one message, None when the peer closed the connection."""
+    header = _recv_exact(sock, _HEADER.size)
+
+    if header is None:
+        return None
+
+    (size,) = _HEADER.unpack(header)
+
+    if size > MAX_FRAME:
+        raise QueueClientError(f"Frame of {size} bytes exceeds the {MAX_FRAME} limit.")
+
+    body = _recv_exact(sock, size)
+
+    if body is None:
+        return None
+
+    return json.loads(body)
+
+
+class QueueClient:
+    """
+    Thin client for `queuectl serve`. Keeps one connection open, so each call
+    is a single round trip instead of a CLI process, an SQLite open and a commit.
+    """
+
+    def __init__(self, path: str = SOCKET_PATH, timeout: float | None = 30.0):
+        self.path = path
+        self.timeout = timeout
+        self.sock: socket.socket | None = None
+
+        # one request in flight per connection, calls may come from several threads
+        self.lock = threading.RLock()
+
+    def _open(self) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.path)
+        return sock
+
+    def connect(self):
+        if self.sock is None:
+            self.sock = self._open()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def call(self, op: str, **params):
+        with self.lock:
+            try:
+                self.connect()
+                send_frame(self.sock, {"op": op, **params})
+                response = recv_frame(self.sock)
+
+            except OSError:
+                # reconnect on the next call instead of reusing a broken socket
+                self.close()
+                raise
+
+            if response is None:
+                self.close()
+                raise QueueClientError("Daemon closed the connection.")
+
+        if not response.get("ok"):
+            raise QueueClientError(response.get("error", "Unknown error."))
+
+        return response.get("result")
+
+    def ping(self) -> bool:
+        return self.call("ping") == "pong"
+
+    def enqueue(self, command: str, **options) -> str:
+        """enqueue one job, options are the job JSON keys (timeout, nice, ...)."""
+        return self.call("enqueue", job={"command": command, **options})["id"]
+
+    def enqueue_batch(self, jobs: list[dict]) -> list[str]:
+        return self.call("enqueue_batch", jobs=jobs)["ids"]
+
+    def status(self) -> dict[str, int]:
+        return self.call("status")
+
+    def list_jobs(self, state: str = "pending", limit: int | None = None) -> list[dict]:
+        return self.call("list", state=state, limit=limit)
+
+    def dlq_list(self, limit: int | None = None) -> list[dict]:
+        return self.list_jobs("dead", limit)
+
+    def dlq_retry(
+        self,
+        job_id: str | None = None,
+        all_jobs: bool = False,
+        since: str | None = None,
+        command_like: str | None = None,
+    ) -> int:
+        return self.call(
+            "dlq_retry",
+            job_id=job_id,
+            all=all_jobs,
+            since=since,
+            command_like=command_like,
+        )["count"]
+
+    def dlq_purge(
+        self,
+        job_id: str | None = None,
+        all_jobs: bool = False,
+        since: str | None = None,
+        command_like: str | None = None,
+    ) -> int:
+        return self.call(
+            "dlq_purge",
+            job_id=job_id,
+            all=all_jobs,
+            since=since,
+            command_like=command_like,
+        )["count"]
+
+
+class BrokerClient(QueueClient):
+    """
+    Client for `queuectl broker` over TCP, used by remote workers. The broker
+    also serves every QueueClient op, so producers on other hosts can enqueue.
+    """
+
+    def __init__(self, address: tuple[str, int], timeout: float | None = 30.0):
+        super().__init__(path=None, timeout=timeout)
+        self.address = address
+
+    def _open(self) -> socket.socket:
+        sock = socket.create_connection(self.address, timeout=self.timeout)
+
+        # small request/response frames, do not wait to coalesce them
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def hello(self, worker_id: str) -> dict:
+        """the broker's max_retries, backoff_base and job_timeout."""
+        return self.call("hello", worker_id=worker_id)
+
+    def claim(
+        self,
+        worker_id: str,
+        host: str,
+        prefetch: int,
+        capacity: dict | None,
+        start: bool = False,
+    ) -> list[dict]:
+        """
+        lease up to prefetch jobs, each with its payload and map inputs. With
+        start the first job is also marked started, as by `start`.
+        """
+        return self.call(
+            "claim",
+            worker_id=worker_id,
+            host=host,
+            prefetch=prefetch,
+            capacity=capacity,
+            start=start,
+        )
+
+    def start(self, worker_id: str, job_id: str) -> bool:
+        """tell the broker a leased job is about to run, False when the lease is gone."""
+        return self.call("start", worker_id=worker_id, job_id=job_id)["held"]
+
+    def ack(
+        self, worker_id: str, job_id: str, start: str | None = None, **result
+    ) -> bool | None:
+        """
+        report a successful run, result holds usage, output and item_results.
+        `start` also starts the next leased job, saving its own round trip, and
+        the result tells whether its lease is held (None without `start`).
+        """
+        return self.call(
+            "ack", worker_id=worker_id, job_id=job_id, start=start, **result
+        )["held"]
+
+    def nack(
+        self, worker_id: str, job_id: str, start: str | None = None, **result
+    ) -> tuple[int | None, bool | None]:
+        """
+        report a failed run, returns the retry delay (None for the DLQ) and
+        whether the `start` job's lease is held, as for ack.
+        """
+        response = self.call(
+            "nack", worker_id=worker_id, job_id=job_id, start=start, **result
+        )
+        return response["delay"], response["held"]
+
+    def heartbeat(
+        self, worker_id: str, job_ids: list[str], running: str | None = None
+    ) -> list[str]:
+        """renew the leases of job_ids, returns those the worker no longer holds."""
+        return self.call(
+            "heartbeat", worker_id=worker_id, job_ids=job_ids, running=running
+        )["lost"]
+
+    def release(self, worker_id: str, job_ids: list[str]) -> int:
+        """hand leased jobs back unrun, their attempt is not counted."""
+        return self.call("release", worker_id=worker_id, job_ids=job_ids)["count"]
@@ -0,0 +1,251 @@
+import os
+import queue
+import signal
+import socket
+import socketserver
+import threading
+from dataclasses import asdict
+import db
+import queue_ctl
+from client import SOCKET_PATH, send_frame, recv_frame
+from model import Job
+
+# upper bound on jobs written by one group transaction
+MAX_GROUP_SIZE = 5000
+
+
+class _PendingEnqueue:
+    def __init__(self, specs: list[dict]):
+        self.specs = specs
+        self.jobs: list[Job] = []
+        self.error: Exception | None = None
+        self.done = threading.Event()
+
+
+class EnqueueBatcher:
+    """
+    Funnels enqueues from all connections through one writer thread.
+
+    While the writer commits a group, new requests pile up in the queue and
+    go out together in the next transaction, so concurrent producers share
+    one commit instead of paying one each.
+    """
+
+    def __init__(self, max_group_size: int = MAX_GROUP_SIZE):
+        self.max_group_size = max_group_size
+        self.requests: queue.Queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, specs: list[dict]) -> list[Job]:
+        pending = _PendingEnqueue(specs)
+        self.requests.put(pending)
+        pending.done.wait()
+
+        if pending.error is not None:
+            raise pending.error
+
+        return pending.jobs
+
+    def stop(self):
+        self.requests.put(None)
+        self.thread.join()
+
+    def _run(self):
+        try:
+            # group commits are the latency of every enqueue, skip the fsync
+            db.use_wal()
+
+            while True:
+                first = self.requests.get()
+
+                if first is None:
+                    return
+
+                group = [first]
+                size = len(first.specs)
+
+                while size < self.max_group_size:
+                    try:
+                        pending = self.requests.get_nowait()
+
+                    except queue.Empty:
+                        break
+
+                    if pending is None:
+                        self.requests.put(None)
+                        break
+
+                    group.append(pending)
+                    size += len(pending.specs)
+
+                self._write(group)
+
+        finally:
+            db.close_conn()
+
+    def _write(self, group: list[_PendingEnqueue]):
+        try:
+            jobs = queue_ctl.enqueue_jobs(
+                [spec for pending in group for spec in pending.specs]
+            )
+
+        except Exception as e:
+            for pending in group:
+                pending.error = e
+                pending.done.set()
+
+            return
+
+        offset = 0
+        for pending in group:
+            pending.jobs = jobs[offset : offset + len(pending.specs)]
+            offset += len(pending.specs)
+            pending.done.set()
+
+
+def _bulk_args(request: dict) -> tuple[str | None, str | None]:
+    since = request.get("since")
+    command_like = request.get("command_like")
+
+    if not (request.get("all") or since or command_like):
+        raise ValueError("Provide a job ID, all or a filter.")
+
+    return (queue_ctl.parse_since(since) if since else None), command_like
+
+
+class RequestHandler(socketserver.BaseRequestHandler):
+    """serves framed JSON requests on one connection until the client hangs up."""
+
+    def handle(self):
+        try:
+            while True:
+                request = recv_frame(self.request)
+
+                if request is None:
+                    return
+
+                try:
+                    response = {"ok": True, "result": self.dispatch(request)}
+
+                except Exception as e:
+                    response = {"ok": False, "error": str(e)}
+
+                send_frame(self.request, response)
+
+        except (ConnectionError, ValueError):
+            # broken pipe or an undecodable frame, drop the connection
+            return
+
+        finally:
+            db.close_conn()
+
+    def dispatch(self, request: dict):
+        op = request.get("op")
+
+        if op == "ping":
+            return "pong"
+
+        if op == "enqueue":
+            spec = queue_ctl.parse_job_spec(request.get("job"))
+            job = self.server.batcher.submit([spec])[0]
+            return {"id": job.id}
+
+        if op == "enqueue_batch":
+            items = request.get("jobs")
+
+            if not isinstance(items, list) or not items:
+                raise ValueError("'jobs' must be a non-empty list.")
+
+            specs = [queue_ctl.parse_job_spec(item) for item in items]
+            jobs = self.server.batcher.submit(specs)
+            return {"ids": [job.id for job in jobs]}
+
+        if op == "status":
+            return queue_ctl.get_status_summary()
+
+        if op == "list":
+            state = request.get("state", "pending")
+
+            if state not in queue_ctl.JOB_STATES:
+                raise ValueError(f"Invalid state '{state}'.")
+
+            limit = request.get("limit")
+
+            if limit is not None and (not isinstance(limit, int) or limit < 0):
+                raise ValueError(f"Invalid limit '{limit}'.")
+
+            jobs = queue_ctl.list_jobs_by_state(state, limit)
+            return [asdict(job) for job in jobs]
+
+        if op == "dlq_retry":
+            if request.get("job_id"):
+                return {"count": int(queue_ctl.retry_dead_job(request["job_id"]))}
+
+            return {"count": queue_ctl.retry_dead_jobs(*_bulk_args(request))}
+
+        if op == "dlq_purge":
+            if request.get("job_id"):
+                return {"count": int(queue_ctl.purge_dead_job(request["job_id"]))}
+
+            return {"count": queue_ctl.purge_dead_jobs(*_bulk_args(request))}
+
+        raise ValueError(f"Unknown op '{op}'.")
+
+
+class QueueServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str):
+        self.batcher = EnqueueBatcher()
+        super().__init__(path, RequestHandler)
+
+
+def _remove_stale_socket(path: str):
+    """delete a socket file left by a daemon that died, refuse if one is alive."""
+    if not os.path.exists(path):
+        return
+
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        probe.connect(path)
+
+    except (ConnectionRefusedError, FileNotFoundError):
+        os.remove(path)
+        return
+
+    finally:
+        probe.close()
+
+    raise RuntimeError(f"A daemon is already listening on {path}.")
+
+
+def serve(path: str = SOCKET_PATH, on_ready=None):
+    """run the daemon in the foreground until SIGTERM/SIGINT."""
+    db.init_db()
+    db.close_conn()
+    _remove_stale_socket(path)
+
+    server = QueueServer(path)
+    os.chmod(path, 0o600)
+
+    def shutdown(signum, frame):
+        # shutdown() blocks until serve_forever returns, so call it off-thread
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    if on_ready is not None:
+        on_ready()
+
+    try:
+        server.serve_forever()
+
+    finally:
+        server.server_close()
+        server.batcher.stop()
+
+        if os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,109 @@
+import time
+from collections import deque
+from datetime import datetime, timezone
+from rich.console import Group
+from rich.table import Table
+import queue_ctl
+from model import Job
+
+
+def _age(timestamp: str | None) -> str:
+    if timestamp is None:
+        return "-"
+
+    then = datetime.fromisoformat(timestamp)
+
+    if then.tzinfo is None:
+        then = then.replace(tzinfo=timezone.utc)
+
+    elapsed = datetime.now(timezone.utc) - then
+    seconds = max(0, int(elapsed.total_seconds()))
+
+    if seconds < 60:
+        return f"{seconds}s"
+
+    if seconds < 3600:
+        return f"{seconds // 60}m {seconds % 60}s"
+
+    return f"{seconds // 3600}h {seconds % 3600 // 60}m"
+
+
+class Dashboard:
+    """
+    State behind `queuectl top`.
+
+    Every refresh reads the trigger-maintained state counts, the processing
+    rows and only the failures newer than the last one seen, so the cost does
+    not grow with the size of the jobs table.
+    """
+
+    def __init__(self, failures_shown: int = 10, window: int = 10):
+        self.failures_shown = failures_shown
+
+        # (monotonic time, completed count) samples for the throughput rate
+        self.samples: deque[tuple[float, int]] = deque(maxlen=window)
+
+        self.counts: dict[str, int] = {}
+        self.inflight: dict[str, int] = {}
+        self.oldest_ready: str | None = None
+        self.failures: list[Job] = []
+        self.failures_cursor: str | None = None
+
+    def refresh(self):
+        self.counts = queue_ctl.get_status_summary()
+        self.samples.append((time.monotonic(), self.counts["completed"]))
+        self.inflight = queue_ctl.inflight_by_worker()
+        self.oldest_ready = queue_ctl.oldest_ready_time()
+
+        new = queue_ctl.recent_failures(self.failures_cursor, self.failures_shown)
+
+        if new:
+            self.failures_cursor = new[0].updated_at
+            seen = {job.id for job in new}
+            kept = [job for job in self.failures if job.id not in seen]
+            self.failures = (new + kept)[: self.failures_shown]
+
+    def throughput(self) -> float:
+        """completed jobs per second over the sample window."""
+        if len(self.samples) < 2:
+            return 0.0
+
+        (start, first), (end, last) = self.samples[0], self.samples[-1]
+        return (last - first) / (end - start) if end > start else 0.0
+
+    def render(self) -> Group:
+        counts = Table(title="Job States", expand=True)
+        for state in self.counts:
+            counts.add_column(state.capitalize(), justify="right")
+        counts.add_row(*(str(count) for count in self.counts.values()))
+
+        summary = Table.grid(padding=(0, 4))
+        summary.add_row(
+            f"Throughput: [bold green]{self.throughput():.2f}[/bold green] jobs/s",
+            f"Oldest ready: [bold yellow]{_age(self.oldest_ready)}[/bold yellow]",
+        )
+
+        inflight = Table(title="In-flight per Worker", expand=True)
+        inflight.add_column("Worker", style="cyan")
+        inflight.add_column("Processing", style="magenta", justify="right")
+        for worker, count in sorted(self.inflight.items()):
+            inflight.add_row(worker, str(count))
+
+        failures = Table(title="Recent Failures", expand=True)
+        failures.add_column("ID", style="cyan")
+        failures.add_column("State", style="red")
+        failures.add_column("Command", style="green")
+        failures.add_column("Attempts", style="magenta", justify="right")
+        failures.add_column("Exit", justify="right")
+        failures.add_column("Age", style="blue", justify="right")
+        for job in self.failures:
+            failures.add_row(
+                job.id,
+                job.state,
+                job.command,
+                str(job.attempts),
+                "-" if job.exit_code is None else str(job.exit_code),
+                _age(job.updated_at),
+            )
+
+        return Group(counts, summary, inflight, failures)
@@ -1,5 +1,6 @@
 import sqlite3
 import threading
+import zlib
 import os
 
 
@@ -8,24 +9,111 @@ DB_PATH = os.path.join(APP_DIR, "queue.db")
 
 _local = threading.local()
 
+# number of database files jobs are partitioned across, read from the
+# 'shards' config key of shard 0 and cached for the life of the process
+_shard_count: int | None = None
 
-def get_conn() -> sqlite3.Connection:
-    conn = getattr(_local, "conn", None)
+# stored in PRAGMA user_version, bump whenever the DDL below changes so
+# existing databases migrate once instead of running it on every command
+SCHEMA_VERSION = 11
+
+# columns added to jobs after the first release, by ALTER TABLE on old databases
+JOB_ADDED_COLUMNS = {
+    "timeout": "INTEGER",
+    "cpu_seconds": "INTEGER",
+    "max_rss": "INTEGER",
+    "nice": "INTEGER",
+    "exit_code": "INTEGER",
+    "run_utime": "REAL",
+    "run_stime": "REAL",
+    "run_maxrss": "INTEGER",
+    "run_wall": "REAL",
+    "worker_id": "TEXT",
+    "cpus": "REAL",
+    "memory_mb": "INTEGER",
+    "has_payload": "INTEGER NOT NULL DEFAULT 0",
+    "parent_id": "TEXT",
+    "map_total": "INTEGER",
+    "cache_ttl": "INTEGER",
+    "cache_key": "TEXT",
+    "host": "TEXT",
+}
+
+
+def shard_path(shard: int) -> str:
+    """shard 0 is the original queue.db, which also holds the config table."""
+    if shard == 0:
+        return DB_PATH
+
+    return os.path.join(APP_DIR, f"queue-{shard}.db")
+
+
+def get_conn(shard: int = 0) -> sqlite3.Connection:
+    conns = getattr(_local, "conns", None)
+
+    if conns is None:
+        conns = {}
+        _local.conns = conns
+
+    conn = conns.get(shard)
 
     if conn is None:
-        conn = sqlite3.connect(DB_PATH)
+        conn = sqlite3.connect(shard_path(shard))
 
         # query results are accessible by column name instead of index
         conn.row_factory = sqlite3.Row
-        _local.conn = conn
+        conns[shard] = conn
 
     return conn
 
 
-def init_db():
-    conn = get_conn()
-    cursor = conn.cursor()
+def use_wal():
+    """
+    Switch every shard to WAL and this thread's connections to
+    synchronous=NORMAL, so a commit appends to the log without an fsync
+    (those happen at checkpoints). WAL is persistent, other processes
+    follow on their next transaction. A crashed process loses nothing, a
+    power loss can drop the last commits.
+    """
+    for shard in range(shard_count()):
+        conn = get_conn(shard)
+
+        try:
+            mode = conn.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+
+        except sqlite3.OperationalError:
+            # another connection holds a lock, keep the rollback journal
+            continue
+
+        # NORMAL is only safe against corruption in WAL mode
+        if mode == "wal":
+            conn.execute("PRAGMA synchronous = NORMAL")
+
+
+def shard_count() -> int:
+    global _shard_count
+
+    if _shard_count is None:
+        try:
+            row = (
+                get_conn()
+                .execute("SELECT value FROM config WHERE key = 'shards'")
+                .fetchone()
+            )
+            _shard_count = int(row["value"]) if row else 1
+
+        except sqlite3.OperationalError:
+            # config table not created yet
+            return 1
+
+    return _shard_count
+
 
+def shard_for_job(job_id: str) -> int:
+    return zlib.crc32(job_id.encode()) % shard_count()
+
+
+def _create_jobs_table(cursor: sqlite3.Cursor):
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS jobs(
         id TEXT PRIMARY KEY,
@@ -35,10 +123,372 @@ def init_db():
         max_retries INTEGER NOT NULL DEFAULT 3,
         created_at TEXT NOT NULL,
         updated_at TEXT NOT NULL,
-        next_run_time TEXT -- for exponential backoff
+        next_run_time TEXT, -- for exponential backoff
+        timeout INTEGER,
+        cpu_seconds INTEGER,
+        max_rss INTEGER,
+        nice INTEGER,
+        exit_code INTEGER,
+        run_utime REAL,
+        run_stime REAL,
+        run_maxrss INTEGER,
+        run_wall REAL, -- NULL when the last attempt ended without a run
+        worker_id TEXT, -- worker that claimed the job last
+        cpus REAL,
+        memory_mb INTEGER,
+        has_payload INTEGER NOT NULL DEFAULT 0, -- env/stdin/cwd live in job_blobs
+        parent_id TEXT, -- map job a chunk belongs to
+        map_total INTEGER, -- number of inputs, set only on map parents
+        cache_ttl INTEGER, -- seconds a cached result may be reused
+        cache_key TEXT, -- hash of the command and its payload
+        host TEXT -- host the claiming worker runs on
+        )
+    """)
+
+    _add_missing_columns(cursor, "jobs", JOB_ADDED_COLUMNS)
+
+    # bulk operations walk one state in rowid order, which SQLite appends to
+    # every index, so each chunk is a range seek instead of a sort
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs(state)")
+    # recent failures filter on state and a time window
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_jobs_state_updated ON jobs(state, updated_at)"
+    )
+    # oldest pending job without scanning the whole state
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_jobs_state_created ON jobs(state, created_at)"
+    )
+
+    # claims skip the admission lock while this index holds no runnable job
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_jobs_declared ON jobs(state) "
+        "WHERE cpus IS NOT NULL OR memory_mb IS NOT NULL"
+    )
+
+    _create_state_counts(cursor)
+    _create_job_blobs(cursor)
+    _create_map_items(cursor)
+    _create_job_cache(cursor)
+    _create_job_events(cursor)
+
+
+def _create_job_blobs(cursor: sqlite3.Cursor):
+    """
+    Payloads (env, stdin, cwd, long commands) and run output kept out of the
+    jobs table, so claims and status only page through scheduling columns.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS job_blobs(
+            job_id TEXT NOT NULL,
+            kind TEXT NOT NULL, -- 'payload' or 'result'
+            compressed INTEGER NOT NULL DEFAULT 0,
+            data BLOB NOT NULL,
+            PRIMARY KEY (job_id, kind)
+        ) WITHOUT ROWID
+    """)
+
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS jobs_blobs_delete AFTER DELETE ON jobs
+        BEGIN
+            DELETE FROM job_blobs WHERE job_id = OLD.id;
+        END
+    """)
+
+
+def _create_map_items(cursor: sqlite3.Cursor):
+    """
+    Inputs of map jobs with the exit code of their last run, one row per
+    input. The parent (state 'waiting') is rolled up by triggers when its
+    chunks finish, so every path that moves a chunk keeps it current.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS map_items(
+            chunk_id TEXT NOT NULL,
+            idx INTEGER NOT NULL, -- position in the parent's input list
+            input TEXT NOT NULL,
+            exit_code INTEGER, -- NULL until the input ran
+            PRIMARY KEY (chunk_id, idx)
+        ) WITHOUT ROWID
+    """)
+
+    # the rollup checks the remaining chunks of one parent
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_jobs_parent ON jobs(parent_id, state) "
+        "WHERE parent_id IS NOT NULL"
+    )
+
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS jobs_map_rollup AFTER UPDATE OF state ON jobs
+        WHEN NEW.parent_id IS NOT NULL
+            AND NEW.state IN ('completed', 'dead', 'cancelled')
+        BEGIN
+            UPDATE jobs
+            SET state = CASE
+                    WHEN EXISTS (
+                        SELECT 1 FROM jobs
+                        WHERE parent_id = NEW.parent_id AND state = 'dead'
+                    ) THEN 'dead'
+                    WHEN EXISTS (
+                        SELECT 1 FROM jobs
+                        WHERE parent_id = NEW.parent_id AND state = 'cancelled'
+                    ) THEN 'cancelled'
+                    ELSE 'completed'
+                END,
+                updated_at = NEW.updated_at
+            WHERE id = NEW.parent_id AND state = 'waiting'
+                AND NOT EXISTS (
+                    SELECT 1 FROM jobs
+                    WHERE parent_id = NEW.parent_id
+                        AND state NOT IN ('completed', 'dead', 'cancelled')
+                );
+        END
+    """)
+
+    # retrying a dead chunk reopens its parent
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS jobs_map_reopen AFTER UPDATE OF state ON jobs
+        WHEN NEW.parent_id IS NOT NULL AND OLD.state = 'dead' AND NEW.state = 'pending'
+        BEGIN
+            UPDATE jobs SET state = 'waiting', updated_at = NEW.updated_at
+            WHERE id = NEW.parent_id AND state = 'dead';
+        END
+    """)
+
+    # retrying a dead parent retries its dead chunks, the parent itself never runs
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS jobs_map_retry AFTER UPDATE OF state ON jobs
+        WHEN NEW.map_total IS NOT NULL AND OLD.state = 'dead' AND NEW.state = 'pending'
+        BEGIN
+            UPDATE jobs
+            SET state = 'pending', attempts = 0, updated_at = NEW.updated_at,
+                next_run_time = NULL
+            WHERE parent_id = NEW.id AND state = 'dead';
+
+            UPDATE jobs SET state = 'waiting' WHERE id = NEW.id;
+        END
+    """)
+
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS jobs_map_delete AFTER DELETE ON jobs
+        WHEN OLD.parent_id IS NOT NULL OR OLD.map_total IS NOT NULL
+        BEGIN
+            DELETE FROM map_items WHERE chunk_id = OLD.id;
+
+            -- triggers do not fire recursively, clear the chunks' items here
+            DELETE FROM map_items
+            WHERE chunk_id IN (SELECT id FROM jobs WHERE parent_id = OLD.id);
+            DELETE FROM jobs WHERE parent_id = OLD.id;
+        END
+    """)
+
+
+def _create_job_cache(cursor: sqlite3.Cursor):
+    """
+    Results of successful cacheable jobs by cache_key, evicted least recently
+    used first. Entry and byte totals are kept by triggers in cache_stats
+    next to the hit/miss counters, so eviction never sums the table.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS job_cache(
+            cache_key TEXT NOT NULL UNIQUE,
+            exit_code INTEGER NOT NULL,
+            compressed INTEGER NOT NULL DEFAULT 0,
+            result BLOB, -- packed stdout/stderr, NULL when the job printed nothing
+            size INTEGER NOT NULL, -- bytes counted against cache_max_mb
+            created_at TEXT NOT NULL, -- when the result was computed
+            last_used_at TEXT NOT NULL
+        )
+    """)
+
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_job_cache_used ON job_cache(last_used_at)"
+    )
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS cache_stats(
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+
+    cursor.execute(
+        "INSERT OR IGNORE INTO cache_stats (name) "
+        "VALUES ('hits'), ('misses'), ('entries'), ('bytes')"
+    )
+
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS job_cache_insert AFTER INSERT ON job_cache
+        BEGIN
+            UPDATE cache_stats SET value = value + 1 WHERE name = 'entries';
+            UPDATE cache_stats SET value = value + NEW.size WHERE name = 'bytes';
+        END
+    """)
+
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS job_cache_delete AFTER DELETE ON job_cache
+        BEGIN
+            UPDATE cache_stats SET value = value - 1 WHERE name = 'entries';
+            UPDATE cache_stats SET value = value - OLD.size WHERE name = 'bytes';
+        END
+    """)
+
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS job_cache_update AFTER UPDATE OF size ON job_cache
+        BEGIN
+            UPDATE cache_stats SET value = value + NEW.size - OLD.size
+            WHERE name = 'bytes';
+        END
+    """)
+
+
+def _create_job_events(cursor: sqlite3.Cursor):
+    """
+    Append-only history of every state change, written by triggers in the
+    transaction that makes the change, whichever code path that is. The
+    time spent in the previous state is stored with each event, so latency
+    reports aggregate single rows instead of pairing them up. Events ending
+    a run also carry the run's wall time measured by the worker, which
+    leaves out the time a prefetched job waited in the worker's buffer.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS job_events(
+            id INTEGER PRIMARY KEY, -- append order
+            job_id TEXT NOT NULL,
+            at TEXT NOT NULL, -- updated_at of the transition
+            state TEXT NOT NULL,
+            prev_state TEXT, -- NULL for the enqueue event
+            seconds REAL, -- time spent in prev_state
+            attempt INTEGER NOT NULL,
+            worker_id TEXT,
+            exit_code INTEGER, -- set on the events that end a run
+            run_wall REAL -- wall time of that run
+        )
+    """)
+
+    _add_missing_columns(cursor, "job_events", {"run_wall": "REAL"})
+
+    # events are kept after their job is purged, for later replay, until
+    # `queuectl prune-history` deletes them through idx_job_events_at
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_job_events_job ON job_events(job_id, id)"
+    )
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_job_events_at ON job_events(at)")
+
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS jobs_event_insert AFTER INSERT ON jobs
+        BEGIN
+            INSERT INTO job_events (job_id, at, state, attempt, worker_id, exit_code)
+            VALUES (
+                NEW.id, NEW.updated_at, NEW.state, NEW.attempts, NEW.worker_id,
+                NEW.exit_code
+            );
+        END
+    """)
+
+    # recreated, older databases have a version without run_wall
+    cursor.execute("DROP TRIGGER IF EXISTS jobs_event_update")
+    cursor.execute("""
+        CREATE TRIGGER jobs_event_update AFTER UPDATE OF state ON jobs
+        WHEN OLD.state != NEW.state
+        BEGIN
+            INSERT INTO job_events (
+                job_id, at, state, prev_state, seconds, attempt, worker_id,
+                exit_code, run_wall
+            )
+            VALUES (
+                NEW.id, NEW.updated_at, NEW.state, OLD.state,
+                (julianday(NEW.updated_at) - julianday(OLD.updated_at)) * 86400.0,
+                NEW.attempts, NEW.worker_id,
+                -- run_wall is cleared by transitions without a run, so neither
+                -- value is left over from an earlier attempt
+                CASE WHEN OLD.state = 'processing' AND NEW.run_wall IS NOT NULL
+                    THEN NEW.exit_code END,
+                CASE WHEN OLD.state = 'processing' THEN NEW.run_wall END
+            );
+        END
+    """)
+
+
+def _create_state_counts(cursor: sqlite3.Cursor):
+    """
+    Per-state job counts kept current by triggers, so status and top read a
+    handful of rows instead of grouping the whole jobs table.
+    """
+    cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'state_counts'"
+    )
+    exists = cursor.fetchone() is not None
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS state_counts(
+            state TEXT PRIMARY KEY,
+            count INTEGER NOT NULL DEFAULT 0
         )
     """)
 
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS jobs_count_insert AFTER INSERT ON jobs
+        BEGIN
+            INSERT INTO state_counts (state, count) VALUES (NEW.state, 1)
+            ON CONFLICT(state) DO UPDATE SET count = count + 1;
+        END
+    """)
+
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS jobs_count_delete AFTER DELETE ON jobs
+        BEGIN
+            UPDATE state_counts SET count = count - 1 WHERE state = OLD.state;
+        END
+    """)
+
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS jobs_count_update AFTER UPDATE OF state ON jobs
+        WHEN OLD.state != NEW.state
+        BEGIN
+            UPDATE state_counts SET count = count - 1 WHERE state = OLD.state;
+            INSERT INTO state_counts (state, count) VALUES (NEW.state, 1)
+            ON CONFLICT(state) DO UPDATE SET count = count + 1;
+        END
+    """)
+
+    # one full scan when upgrading a database that already holds jobs
+    if not exists:
+        cursor.execute(
+            "INSERT INTO state_counts (state, count) "
+            "SELECT state, count(*) FROM jobs GROUP BY state"
+        )
+
+
+def _schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def _init_shard(shard: int):
+    conn = get_conn(shard)
+
+    # hold the write lock so concurrent writers cannot slip between the
+    # trigger creation and the seeding of state_counts
+    conn.execute("BEGIN IMMEDIATE")
+    _create_jobs_table(conn.cursor())
+    conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    conn.commit()
+
+
+def init_db():
+    if not os.path.isdir(APP_DIR):
+        os.makedirs(APP_DIR, exist_ok=True)
+
+    conn = get_conn()
+
+    # hot path: the schema is already current, skip the DDL and its commit
+    if _schema_version(conn) == SCHEMA_VERSION:
+        return
+
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+
+    _create_jobs_table(cursor)
+
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS config(
             key TEXT PRIMARY KEY,
@@ -52,16 +502,51 @@ def init_db():
     cursor.execute(
         "INSERT OR IGNORE INTO config (key, value) VALUES('backoff_base', '2')"
     )
+    cursor.execute(
+        "INSERT OR IGNORE INTO config (key, value) VALUES('job_timeout', '60')"
+    )
+    cursor.execute("INSERT OR IGNORE INTO config (key, value) VALUES('shards', '1')")
+
+    # 0 means detect from the host
+    cursor.execute(
+        "INSERT OR IGNORE INTO config (key, value) VALUES('host_cpus', '0')"
+    )
+    cursor.execute(
+        "INSERT OR IGNORE INTO config (key, value) VALUES('host_memory_mb', '0')"
+    )
+
+    # per shard limits of the result cache
+    cursor.execute(
+        "INSERT OR IGNORE INTO config (key, value) VALUES('cache_max_entries', '10000')"
+    )
+    cursor.execute(
+        "INSERT OR IGNORE INTO config (key, value) VALUES('cache_max_mb', '64')"
+    )
 
+    cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
     conn.commit()
 
+    for shard in range(1, shard_count()):
+        _init_shard(shard)
+
+
+def _add_missing_columns(cursor: sqlite3.Cursor, table: str, columns: dict[str, str]):
+    cursor.execute(f"PRAGMA table_info({table})")
+    existing = {row["name"] for row in cursor.fetchall()}
+
+    for name, col_type in columns.items():
+        if name not in existing:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {col_type}")
+
 
 def close_conn():
-    conn = getattr(_local, "conn", None)
+    conns = getattr(_local, "conns", None)
 
-    if conn is not None:
-        conn.close()
-        _local.conn = None
+    if conns:
+        for conn in conns.values():
+            conn.close()
+
+        _local.conns = None
 
 
 def load_config() -> dict[str, str | int]:
@@ -78,13 +563,40 @@ def load_config() -> dict[str, str | int]:
     if "backoff_base" in config:
         config["backoff_base"] = int(config["backoff_base"])
 
+    if "job_timeout" in config:
+        config["job_timeout"] = int(config["job_timeout"])
+
+    if "shards" in config:
+        config["shards"] = int(config["shards"])
+
+    if "host_cpus" in config:
+        config["host_cpus"] = float(config["host_cpus"])
+
+    if "host_memory_mb" in config:
+        config["host_memory_mb"] = int(config["host_memory_mb"])
+
+    if "cache_max_entries" in config:
+        config["cache_max_entries"] = int(config["cache_max_entries"])
+
+    if "cache_max_mb" in config:
+        config["cache_max_mb"] = int(config["cache_max_mb"])
+
     return config
 
 
 def update_config(key: str, value: str):
+    global _shard_count
+
     conn = get_conn()
     with conn:
         cursor = conn.cursor()
         cursor.execute(
             "INSERT OR REPLACE INTO config (key, value) VALUES(?, ?)", (key, value)
         )
+
+    if key == "shards":
+        # create the new shard files now, init_db skips them once the schema is current
+        _shard_count = None
+
+        for shard in range(1, shard_count()):
+            _init_shard(shard)
@@ -0,0 +1,49 @@
+import sys
+
+
+def fast_enqueue(job_json: str) -> bool:
+    """
+    Enqueue without importing typer or rich. Returns False when the input
+    needs the full CLI, which then also produces the usual error messages.
+    """
+    import json
+    import db
+    import queue_ctl
+
+    try:
+        data = json.loads(job_json)
+        items = data if isinstance(data, list) else [data]
+        specs = [queue_ctl.parse_job_spec(item) for item in items]
+
+    except ValueError:
+        return False
+
+    if not specs:
+        return False
+
+    try:
+        db.init_db()
+        jobs = queue_ctl.enqueue_jobs(specs)
+
+    finally:
+        db.close_conn()
+
+    sys.stdout.write("".join(f"Job enqueued with ID: {job.id}\n" for job in jobs))
+    return True
+
+
+def main():
+    """console entry point, `queuectl enqueue '<json>'` skips the CLI framework."""
+    args = sys.argv[1:]
+
+    if len(args) == 2 and args[0] == "enqueue" and not args[1].startswith("-"):
+        if fast_enqueue(args[1]):
+            return
+
+    from main import app
+
+    app()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,15 @@
 import typer
 import os
+import sys
 import json
 import db
 import queue_ctl
+import profiling
 import time
 import signal
-from worker import Worker
-from rich.table import Table
-from rich.console import Console
+
+# rich, the worker module and pstats are imported inside the commands that
+# need them, `queuectl enqueue` in a shell loop pays for every import here
 
 
 app = typer.Typer(help="queuectl: A CLI-based job queue system.")
@@ -20,50 +22,109 @@ app.add_typer(dlq_app, name="dlq", help="Manage Dead Letter Queue.")
 config_app = typer.Typer()
 app.add_typer(config_app, name="config", help="Manage Queue configuration.")
 
-console = Console()
+profile_app = typer.Typer()
+app.add_typer(profile_app, name="profile", help="Inspect worker profiles.")
+
+cache_app = typer.Typer()
+app.add_typer(cache_app, name="cache", help="Inspect the job result cache.")
+
+
+class LazyConsole:
+    """rich Console created on first use, so commands that print nothing fancy skip importing rich."""
+
+    _console = None
+
+    @property
+    def rich(self):
+        """the underlying Console, for APIs that need the real object."""
+        if self._console is None:
+            from rich.console import Console
+
+            self._console = Console()
+
+        return self._console
+
+    def __getattr__(self, name):
+        return getattr(self.rich, name)
+
+
+console = LazyConsole()
 
 # track running workers
 PID_DIR = "/tmp/queuectl_pids"
-LOG_DIR = "/tmp/queuectl_logs"
+
+CONFIG_KEYS = (
+    "max_retries",
+    "backoff_base",
+    "job_timeout",
+    "shards",
+    "host_cpus",
+    "host_memory_mb",
+    "cache_max_entries",
+    "cache_max_mb",
+)
+
+
+def parse_since(value: str) -> str:
+    try:
+        return queue_ctl.parse_since(value)
+
+    except ValueError as e:
+        console.print(f"[bold red]Error: {e}[/bold red]")
+        raise typer.Exit(code=1)
+
+
+def run_bulk(description: str, total: int, operation) -> int:
+    """run a chunked bulk operation behind a progress bar."""
+    from rich.progress import Progress
+
+    with Progress(console=console.rich, transient=True) as progress:
+        task = progress.add_task(description, total=total)
+        return operation(lambda n: progress.advance(task, n))
 
 
 @app.callback()
 def main():
-    os.makedirs(db.APP_DIR, exist_ok=True)
-    os.makedirs(PID_DIR, exist_ok=True)
-    os.makedirs(LOG_DIR, exist_ok=True)
     db.init_db()
 
 
 @app.command()
 def enqueue(
     job_json: str = typer.Argument(
-        ..., help='A JSON string defining the job. e.g., \'{"command": "sleep 2"}\''
+        ...,
+        help='A JSON string defining the job, e.g. \'{"command": "sleep 2"}\'. '
+        "A JSON list enqueues several jobs at once, '-' reads one job per line from stdin.",
     ),
 ):
     """
-    Add a new job to the queue.
+    Add new job(s) to the queue.
     """
     try:
-        data = json.loads(job_json)
-        command = data.get("command")
+        if job_json == "-":
+            items = [json.loads(line) for line in sys.stdin if line.strip()]
 
-        if not command:
-            console.print(
-                "[bold red]Error: Job JSON must contain a 'command'.[/bold red]"
-            )
+        else:
+            data = json.loads(job_json)
+            items = data if isinstance(data, list) else [data]
+
+        if not items:
+            console.print("[bold red]Error: No jobs provided.[/bold red]")
             raise typer.Exit(code=1)
 
-        job = queue_ctl.enqueue_job(command=command)
-        console.print(f"Job enqueued with ID: {job.id}")
+        specs = [queue_ctl.parse_job_spec(item) for item in items]
+        jobs = queue_ctl.enqueue_jobs(specs)
+
+        # plain echo keeps rich out of the enqueue hot path
+        for job in jobs:
+            typer.echo(f"Job enqueued with ID: {job.id}")
 
     except json.JSONDecodeError:
         console.print("Error: Invalid JSON string provided.")
         raise typer.Exit(code=1)
 
-    # except Exception as e:
-    #     console.print(f"An error occurred: {e}")
-    #     raise typer.Exit(code=1)
+    except ValueError as e:
+        console.print(f"[bold red]Error: {e}[/bold red]")
+        raise typer.Exit(code=1)
 
     finally:
         db.close_conn()
@@ -77,6 +138,8 @@ def status():
     try:
         summary = queue_ctl.get_status_summary()
 
+        from rich.table import Table
+
         table = Table(title="Job Queue Status")
         table.add_column("State", style="cyan")
         table.add_column("Count", style="magenta", justify="right")
@@ -96,19 +159,21 @@ def list_jobs(
         "pending",
         "--state",
         "-s",
-        help="Filter jobs by state (pending, processing, completed, failed, dead)",
+        help="Filter jobs by state (pending, processing, completed, failed, dead, cancelled, waiting)",
     ),
 ):
     """
     List jobs in the queue, filtered by state.
     """
     try:
-        if state not in ("pending", "processing", "completed", "failed", "dead"):
+        if state not in queue_ctl.JOB_STATES:
             console.print(f"[bold red]Error: Invalid state '{state}'.[/bold red]")
             raise typer.Exit(code=1)
 
         jobs = queue_ctl.list_jobs_by_state(state)
 
+        from rich.table import Table
+
         table = Table(title=f"{state.capitalize()} Jobs", show_lines=True, expand=True)
         table.add_column("ID", style="cyan")
         table.add_column("Command", style="green")
@@ -124,13 +189,305 @@ def list_jobs(
         db.close_conn()
 
 
+@app.command()
+def output(
+    job_id: str = typer.Argument(..., help="The ID of the job."),
+):
+    """
+    Show the stored stdout/stderr of the last run of a job.
+    """
+    try:
+        result = queue_ctl.load_result(job_id)
+
+        if result is None:
+            console.print(f"[bold red]Error: No output stored for job {job_id}.[/bold red]")
+            raise typer.Exit(code=1)
+
+        # raw write, job output is not rich markup
+        sys.stdout.write(result["stdout"])
+        sys.stderr.write(result["stderr"])
+
+    finally:
+        db.close_conn()
+
+
+@app.command()
+def items(
+    job_id: str = typer.Argument(..., help="The ID of the map job (the parent)."),
+    limit: int = typer.Option(20, "--limit", "-n", help="Failed inputs to show."),
+):
+    """
+    Show per-input progress of a map job and its failed inputs.
+    """
+    try:
+        progress = queue_ctl.get_map_progress(job_id, limit)
+
+        if progress is None:
+            console.print(f"[bold red]Error: Job {job_id} is not a map job.[/bold red]")
+            raise typer.Exit(code=1)
+
+        parent, counts, failed = progress
+
+        from rich.table import Table
+
+        table = Table(title=f"Map Job {parent.id} ({parent.state})")
+        table.add_column("Inputs", style="cyan")
+        table.add_column("Count", style="magenta", justify="right")
+        table.add_row("Total", str(parent.map_total))
+
+        for name, count in counts.items():
+            table.add_row(name.replace("_", " ").capitalize(), str(count))
+
+        console.print(table)
+
+        if failed:
+            table = Table(title="Failed Inputs", expand=True)
+            table.add_column("Index", justify="right")
+            table.add_column("Input", style="green")
+            table.add_column("Exit", style="red", justify="right")
+
+            for idx, value, exit_code in failed:
+                table.add_row(str(idx), value, str(exit_code))
+
+            console.print(table)
+
+    finally:
+        db.close_conn()
+
+
+@app.command()
+def history(
+    job_id: str = typer.Argument(..., help="The ID of the job."),
+):
+    """
+    Show every state change of a job: when each attempt was claimed, how long it ran and how it ended.
+    """
+    try:
+        events = queue_ctl.job_history(job_id)
+
+        if not events:
+            console.print(f"[bold red]Error: No history recorded for job {job_id}.[/bold red]")
+            raise typer.Exit(code=1)
+
+        from rich.table import Table
+
+        table = Table(title=f"History of Job {job_id}", expand=True)
+        table.add_column("At", style="blue")
+        table.add_column("Transition", style="cyan")
+        table.add_column("Attempt", style="magenta", justify="right")
+        table.add_column("Worker")
+        table.add_column("Exit", justify="right")
+        table.add_column("After (s)", style="green", justify="right")
+        table.add_column("Run (s)", style="green", justify="right")
+
+        for event in events:
+            table.add_row(
+                event.at,
+                event.state
+                if event.prev_state is None
+                else f"{event.prev_state} -> {event.state}",
+                str(event.attempt),
+                event.worker_id or "-",
+                "-" if event.exit_code is None else str(event.exit_code),
+                "-" if event.seconds is None else f"{event.seconds:.3f}",
+                "-" if event.run_wall is None else f"{event.run_wall:.3f}",
+            )
+
+        console.print(table)
+
+    finally:
+        db.close_conn()
+
+
+@app.command()
+def latency(
+    since: str = typer.Option(
+        "24h", "--since", help="Only transitions newer than an age (30m, 2d) or ISO timestamp."
+    ),
+):
+    """
+    Report queue wait, retry wait, run and end-to-end times from the job history.
+    """
+    try:
+        report = queue_ctl.latency_report(parse_since(since))
+
+        if not report:
+            console.print(f"No job transitions recorded since {since}.")
+            return
+
+        from rich.table import Table
+
+        table = Table(title=f"Job Latency (seconds, since {since})")
+        table.add_column("Phase", style="cyan")
+        table.add_column("Count", style="magenta", justify="right")
+
+        for column in ("Mean", "P50", "P95", "P99", "Max"):
+            table.add_column(column, style="green", justify="right")
+
+        for phase, stats in report.items():
+            table.add_row(
+                phase.replace("_", " ").capitalize(),
+                str(stats["count"]),
+                *(
+                    f"{stats[key]:.3f}"
+                    for key in ("avg", "p50", "p95", "p99", "max")
+                ),
+            )
+
+        console.print(table)
+
+    finally:
+        db.close_conn()
+
+
+@app.command("prune-history")
+def prune_history(
+    before: str = typer.Option(
+        ...,
+        "--before",
+        help="Delete transitions older than an age (30m, 2d) or ISO timestamp.",
+    ),
+):
+    """
+    Delete old job history. The history is kept after jobs are purged, so prune it to bound its size.
+    """
+    try:
+        cutoff = parse_since(before)
+        pruned = run_bulk(
+            "Pruning job history",
+            queue_ctl.count_events(cutoff),
+            lambda on_progress: queue_ctl.prune_events(
+                cutoff, on_progress=on_progress
+            ),
+        )
+        console.print(f"Deleted {pruned} history event(s).")
+
+    finally:
+        db.close_conn()
+
+
+@app.command()
+def top(
+    interval: float = typer.Option(1.0, "--interval", "-i", help="Seconds between refreshes."),
+):
+    """
+    Live dashboard of job states, throughput, in-flight jobs and failures.
+    """
+    from rich.live import Live
+    from dashboard import Dashboard
+
+    board = Dashboard()
+
+    try:
+        board.refresh()
+
+        with Live(board.render(), console=console.rich, auto_refresh=False) as live:
+            while True:
+                time.sleep(interval)
+                board.refresh()
+                live.update(board.render(), refresh=True)
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        db.close_conn()
+
+
+@app.command()
+def serve(
+    socket_path: str | None = typer.Option(
+        None,
+        "--socket",
+        help="Unix socket to listen on (default: ~/.queuectl/queuectl.sock).",
+    ),
+):
+    """
+    Run the local daemon that serves enqueue/status/list/DLQ over a Unix socket.
+    """
+    import daemon
+    from client import SOCKET_PATH
+
+    path = socket_path or SOCKET_PATH
+
+    try:
+        daemon.serve(
+            path,
+            on_ready=lambda: console.print(f"Listening on [bold cyan]{path}[/bold cyan]"),
+        )
+
+    except RuntimeError as e:
+        console.print(f"[bold red]Error: {e}[/bold red]")
+        raise typer.Exit(code=1)
+
+    console.print("Daemon stopped.")
+
+
+@app.command()
+def broker(
+    host: str = typer.Option(
+        "127.0.0.1", "--host", help="Address to listen on, 0.0.0.0 for every interface."
+    ),
+    port: int = typer.Option(7650, "--port", "-p", help="TCP port to listen on."),
+    lease_timeout: float = typer.Option(
+        30.0,
+        "--lease-timeout",
+        help="Seconds without a heartbeat before a remote worker's jobs are reclaimed.",
+    ),
+):
+    """
+    Run the TCP broker that remote workers claim jobs from (`worker start --broker`).
+    """
+    import broker as broker_server
+
+    try:
+        broker_server.serve(
+            host,
+            port,
+            lease_timeout,
+            on_ready=lambda address: console.print(
+                f"Broker listening on [bold cyan]{address[0]}:{address[1]}[/bold cyan]"
+            ),
+        )
+
+    except OSError as e:
+        console.print(f"[bold red]Error: {e}[/bold red]")
+        raise typer.Exit(code=1)
+
+    console.print("Broker stopped.")
+
+
 @worker_app.command("start")
 def worker_start(
     count: int = typer.Option(1, "--count", "-c", help="Number of workers to start."),
+    profile: bool = typer.Option(
+        False,
+        "--profile",
+        help=f"Run workers under cProfile, writing dumps to {profiling.PROFILE_DIR}.",
+    ),
+    broker: str | None = typer.Option(
+        None,
+        "--broker",
+        help="Claim jobs from a `queuectl broker` at host:port instead of the local database.",
+    ),
+    prefetch: int = typer.Option(
+        4, "--prefetch", help="Jobs leased per claim from the broker."
+    ),
 ):
     """
     Start worker(s).
     """
+    from worker import Worker
+    from client import parse_address
+
+    try:
+        address = parse_address(broker) if broker else None
+
+    except ValueError as e:
+        console.print(f"[bold red]Error: {e}[/bold red]")
+        raise typer.Exit(code=1)
+
+    os.makedirs(PID_DIR, exist_ok=True)
     console.print(f"Starting {count} worker(s) in the background...")
     for i in range(count):
         pid = os.fork()
@@ -147,6 +504,12 @@ def worker_start(
             os.close(dev_null)
 
             worker_id = f"worker-{os.getpid()}"
+
+            if address is not None:
+                # pids repeat across hosts, the broker tells workers apart by id
+                import socket
+
+                worker_id = f"worker-{socket.gethostname()}-{os.getpid()}"
             pid_path = os.path.join(PID_DIR, f"{os.getpid()}.pid")
 
             with open(pid_path, "w") as f:
@@ -155,8 +518,13 @@ def worker_start(
             # close any parent connectin before running worker
             db.close_conn()
 
-            worker = Worker(worker_id)
-            worker.run()
+            worker = Worker(worker_id, home_shard=i, broker=address, prefetch=prefetch)
+
+            if profile:
+                profiling.profile_call(worker_id, worker.run)
+
+            else:
+                worker.run()
 
             os.remove(pid_path)
             os._exit(0)
@@ -177,7 +545,9 @@ def worker_stop():
     console.print("Stopping all running workers...")
     stopped_count = 0
 
-    for pid_file in os.listdir(PID_DIR):
+    pid_files = os.listdir(PID_DIR) if os.path.isdir(PID_DIR) else []
+
+    for pid_file in pid_files:
         if pid_file.endswith(".pid"):
             pid_path = os.path.join(PID_DIR, pid_file)
 
@@ -219,21 +589,334 @@ def dlq_list():
 
 
 @dlq_app.command("retry")
-def dlq_retry(job_id: str = typer.Argument(..., help="The ID of the job to retry.")):
+def dlq_retry(
+    job_id: str | None = typer.Argument(None, help="The ID of the job to retry."),
+    all_jobs: bool = typer.Option(
+        False, "--all", help="Retry every dead job matching the filters."
+    ),
+    since: str | None = typer.Option(
+        None,
+        "--since",
+        help="Only jobs that died since this time (ISO timestamp or age like 30m, 2h, 1d).",
+    ),
+    command_like: str | None = typer.Option(
+        None,
+        "--command-like",
+        "--filter",
+        help="Only jobs whose command matches this SQL LIKE pattern, e.g. '%backup%'.",
+    ),
+):
     """
-    Put a dead job back to the 'pending' state.
+    Put dead job(s) back to the 'pending' state.
     """
     try:
-        success = queue_ctl.retry_dead_job(job_id)
+        if job_id is not None:
+            success = queue_ctl.retry_dead_job(job_id)
 
-        if success:
-            console.print(f"Job {job_id} moved back to 'pending'.")
+            if success:
+                console.print(f"Job {job_id} moved back to 'pending'.")
 
-        else:
-            console.print(f"[bold red]Error: Job {job_id} not found in DLQ.[/bold red]")
+            else:
+                console.print(
+                    f"[bold red]Error: Job {job_id} not found in DLQ.[/bold red]"
+                )
+                raise typer.Exit(code=1)
+
+            return
+
+        if not (all_jobs or since or command_like):
+            console.print(
+                "[bold red]Error: Provide a job ID, --all or a filter.[/bold red]"
+            )
+            raise typer.Exit(code=1)
+
+        cutoff = parse_since(since) if since else None
+        total = queue_ctl.count_jobs("dead", cutoff, command_like)
+        retried = run_bulk(
+            "Retrying dead jobs",
+            total,
+            lambda on_progress: queue_ctl.retry_dead_jobs(
+                cutoff, command_like, on_progress=on_progress
+            ),
+        )
+        console.print(f"Moved {retried} dead job(s) back to 'pending'.")
+
+    except typer.Exit:
+        raise
+
+    except Exception as e:
+        console.print(f"[bold red]An error occurred: {e}[/bold red]")
+        raise typer.Exit(code=1)
+
+    finally:
+        db.close_conn()
+
+
+@dlq_app.command("purge")
+def dlq_purge(
+    job_id: str | None = typer.Argument(None, help="The ID of the job to delete."),
+    all_jobs: bool = typer.Option(
+        False, "--all", help="Delete every dead job matching the filters."
+    ),
+    since: str | None = typer.Option(
+        None,
+        "--since",
+        help="Only jobs that died since this time (ISO timestamp or age like 30m, 2h, 1d).",
+    ),
+    command_like: str | None = typer.Option(
+        None,
+        "--command-like",
+        "--filter",
+        help="Only jobs whose command matches this SQL LIKE pattern, e.g. '%backup%'.",
+    ),
+):
+    """
+    Permanently delete dead job(s) from the Dead Letter Queue.
+    """
+    try:
+        if job_id is not None:
+            try:
+                purged = queue_ctl.purge_dead_job(job_id)
+
+            except ValueError as e:
+                console.print(f"[bold red]Error: {e}[/bold red]")
+                raise typer.Exit(code=1)
+
+            if purged:
+                console.print(f"Job {job_id} deleted from DLQ.")
+
+            else:
+                console.print(
+                    f"[bold red]Error: Job {job_id} not found in DLQ.[/bold red]"
+                )
+                raise typer.Exit(code=1)
+
+            return
+
+        if not (all_jobs or since or command_like):
+            console.print(
+                "[bold red]Error: Provide a job ID, --all or a filter.[/bold red]"
+            )
+            raise typer.Exit(code=1)
+
+        cutoff = parse_since(since) if since else None
+        total = queue_ctl.count_jobs("dead", cutoff, command_like, top_level=True)
+        purged = run_bulk(
+            "Purging dead jobs",
+            total,
+            lambda on_progress: queue_ctl.purge_dead_jobs(
+                cutoff, command_like, on_progress=on_progress
+            ),
+        )
+        console.print(f"Deleted {purged} dead job(s).")
+
+    except typer.Exit:
+        raise
 
     except Exception as e:
         console.print(f"[bold red]An error occurred: {e}[/bold red]")
+        raise typer.Exit(code=1)
+
+    finally:
+        db.close_conn()
+
+
+@app.command()
+def cancel(
+    job_id: str | None = typer.Argument(None, help="The ID of the job to cancel."),
+    state: str = typer.Option(
+        "pending",
+        "--state",
+        "-s",
+        help="Cancel jobs in this state (pending, failed).",
+    ),
+    all_jobs: bool = typer.Option(
+        False, "--all", help="Cancel every job in the state matching the filters."
+    ),
+    since: str | None = typer.Option(
+        None,
+        "--since",
+        help="Only jobs updated since this time (ISO timestamp or age like 30m, 2h, 1d).",
+    ),
+    command_like: str | None = typer.Option(
+        None,
+        "--command-like",
+        "--filter",
+        help="Only jobs whose command matches this SQL LIKE pattern, e.g. '%backup%'.",
+    ),
+):
+    """
+    Cancel pending or failed job(s) so workers never pick them up.
+    """
+    try:
+        if job_id is not None:
+            if queue_ctl.cancel_job(job_id):
+                console.print(f"Job {job_id} cancelled.")
+
+            else:
+                console.print(
+                    f"[bold red]Error: Job {job_id} not found or not cancellable.[/bold red]"
+                )
+                raise typer.Exit(code=1)
+
+            return
+
+        if state not in ("pending", "failed"):
+            console.print(
+                f"[bold red]Error: Jobs in state '{state}' cannot be cancelled.[/bold red]"
+            )
+            raise typer.Exit(code=1)
+
+        if not (all_jobs or since or command_like):
+            console.print(
+                "[bold red]Error: Provide a job ID, --all or a filter.[/bold red]"
+            )
+            raise typer.Exit(code=1)
+
+        cutoff = parse_since(since) if since else None
+        total = queue_ctl.count_jobs(state, cutoff, command_like)
+        cancelled = run_bulk(
+            f"Cancelling {state} jobs",
+            total,
+            lambda on_progress: queue_ctl.cancel_jobs(
+                state, cutoff, command_like, on_progress=on_progress
+            ),
+        )
+        console.print(f"Cancelled {cancelled} {state} job(s).")
+
+    except typer.Exit:
+        raise
+
+    except Exception as e:
+        console.print(f"[bold red]An error occurred: {e}[/bold red]")
+        raise typer.Exit(code=1)
+
+    finally:
+        db.close_conn()
+
+
+def check_positive_int(key: str, value: str):
+    if not value.isdigit() or int(value) < 1:
+        console.print(
+            f"[bold red]Error: '{key}' must be a positive integer.[/bold red]"
+        )
+        raise typer.Exit(code=1)
+
+
+def check_shard_resize(value: str):
+    """refuse shard counts that would strand jobs in dropped shard files."""
+    check_positive_int("shards", value)
+
+    for shard in range(int(value), db.shard_count()):
+        if queue_ctl.count_shard_jobs(shard) > 0:
+            console.print(
+                f"[bold red]Error: Shard {shard} still holds jobs, "
+                f"cannot shrink to {value} shard(s).[/bold red]"
+            )
+            raise typer.Exit(code=1)
+
+
+@profile_app.command("report")
+def profile_report(
+    limit: int = typer.Option(25, "--limit", "-n", help="Number of functions to show."),
+    sort: str = typer.Option(
+        "cumulative", "--sort", help="pstats sort key (cumulative, tottime, calls)."
+    ),
+):
+    """
+    Aggregate the profiles written by 'worker start --profile' across workers.
+    """
+    files = profiling.profile_files()
+
+    if not files:
+        console.print(
+            f"No profiles found in {profiling.PROFILE_DIR}. "
+            "Start workers with 'worker start --profile' and stop them first."
+        )
+        raise typer.Exit(code=1)
+
+    phase_stats = profiling.merge_phases()
+
+    from rich.table import Table
+
+    table = Table(title=f"Worker Phases ({len(files)} worker(s))")
+    table.add_column("Phase", style="cyan")
+    table.add_column("Calls", style="magenta", justify="right")
+    table.add_column("Total (s)", style="green", justify="right")
+    table.add_column("Mean (ms)", style="blue", justify="right")
+
+    for name, stats in sorted(
+        phase_stats.items(), key=lambda item: item[1]["total"], reverse=True
+    ):
+        mean_ms = stats["total"] / stats["count"] * 1000 if stats["count"] else 0.0
+        table.add_row(
+            name, str(stats["count"]), f"{stats['total']:.3f}", f"{mean_ms:.3f}"
+        )
+
+    console.print(table)
+
+    import io
+    import pstats
+
+    buffer = io.StringIO()
+    stats = pstats.Stats(*files, stream=buffer)
+
+    try:
+        stats.strip_dirs().sort_stats(sort).print_stats(limit)
+
+    except KeyError:
+        console.print(f"[bold red]Error: Invalid sort key '{sort}'.[/bold red]")
+        raise typer.Exit(code=1)
+
+    console.print(buffer.getvalue(), markup=False, highlight=False, soft_wrap=True)
+
+
+@profile_app.command("clear")
+def profile_clear():
+    """
+    Delete the profiles written by earlier profiled workers.
+    """
+    removed = profiling.clear_profiles()
+    console.print(f"Removed {removed} profile file(s).")
+
+
+@cache_app.command("stats")
+def cache_stats():
+    """
+    Show hits, misses and size of the result cache.
+    """
+    try:
+        stats = queue_ctl.get_cache_stats()
+        lookups = stats["hits"] + stats["misses"]
+
+        from rich.table import Table
+
+        table = Table(title="Result Cache")
+        table.add_column("Metric", style="cyan")
+        table.add_column("Value", style="magenta", justify="right")
+
+        table.add_row("Hits", str(stats["hits"]))
+        table.add_row("Misses", str(stats["misses"]))
+        table.add_row(
+            "Hit rate", f"{stats['hits'] / lookups:.1%}" if lookups else "-"
+        )
+        table.add_row("Entries", str(stats["entries"]))
+        table.add_row("Size (MB)", f"{stats['bytes'] / (1024 * 1024):.2f}")
+
+        console.print(table)
+
+    finally:
+        db.close_conn()
+
+
+@cache_app.command("clear")
+def cache_clear():
+    """
+    Drop every cached result, cacheable jobs run again on their next enqueue.
+    """
+    try:
+        removed = queue_ctl.clear_cache()
+        console.print(f"Removed {removed} cached result(s).")
 
     finally:
         db.close_conn()
@@ -247,6 +930,8 @@ def config_list():
     try:
         config = db.load_config()
 
+        from rich.table import Table
+
         table = Table(title="Queue Configuration")
         table.add_column("Key", style="cyan")
         table.add_column("Value", style="magenta")
@@ -269,15 +954,27 @@ def config_set(
     Update the configuration values for specific key.
     """
     try:
-        if key not in ("max_retries", "backoff_base"):
+        if key not in CONFIG_KEYS:
             console.print(
                 f"[bold yellow]Warning: '{key}' is not recognized config key.[/bold yellow]"
             )
-            console.print("Recognized keys are: 'max_retries', 'backoff_base'.")
+            console.print(
+                "Recognized keys are: " + ", ".join(f"'{k}'" for k in CONFIG_KEYS) + "."
+            )
+
+        if key == "shards":
+            check_shard_resize(value)
+
+        # 0 would kill every job at once, anything else breaks load_config
+        if key == "job_timeout":
+            check_positive_int(key, value)
 
         db.update_config(key, value)
         console.print(f"Config set: [bold green]{key} = {value}[/bold green]")
 
+    except typer.Exit:
+        raise
+
     except Exception as e:
         console.print(f"[bold red]An error occurred: {e}[/bold red]")
         raise typer.Exit(code=1)
@@ -19,7 +19,85 @@ class Job:
     )
     next_run_time: str | None = None  # when using backoff
 
+    # per-job limits, None falls back to worker defaults
+    timeout: int | None = None  # wall clock seconds
+    cpu_seconds: int | None = None  # RLIMIT_CPU
+    max_rss: int | None = None  # megabytes, enforced as RLIMIT_AS
+    nice: int | None = None
+
+    # resource usage of the last run
+    exit_code: int | None = None
+    run_utime: float | None = None
+    run_stime: float | None = None
+    run_maxrss: int | None = None  # kilobytes
+    run_wall: float | None = None  # seconds, None when the attempt did not run
+    worker_id: str | None = None  # worker that claimed the job last
+    host: str | None = None  # host of that worker, for admission
+
+    # declared needs, claimed only when they fit the host's free capacity
+    cpus: float | None = None
+    memory_mb: int | None = None
+
+    # env/stdin/cwd or the full command are stored out of row in job_blobs
+    has_payload: int = 0
+
+    # map jobs: chunks point at their parent, the parent counts the inputs
+    parent_id: str | None = None
+    map_total: int | None = None
+
+    # opt-in result reuse: identical cache_key completed within cache_ttl seconds
+    cache_ttl: int | None = None
+    cache_key: str | None = None
+
+    # database file the job lives in, not stored in the row itself
+    shard: int = 0
+
     @classmethod
-    def row_to_job(cls, row: sqlite3.Row):
+    def row_to_job(cls, row: sqlite3.Row, shard: int = 0):
         """create a Job instance from database row."""
-        return cls(**dict(row))
+        return cls(**dict(row), shard=shard)
+
+
+@dataclass
+class JobPayload:
+    """out-of-row job data, loaded only when a worker runs the job."""
+
+    command: str | None = None  # set when the command was too long to keep inline
+    env: dict[str, str] | None = None
+    stdin: str | None = None
+    cwd: str | None = None
+
+
+@dataclass
+class JobEvent:
+    """one state change of a job, as recorded in job_events."""
+
+    job_id: str
+    at: str
+    state: str
+    prev_state: str | None  # None for the enqueue event
+    seconds: float | None  # time spent in prev_state
+    attempt: int
+    worker_id: str | None
+    exit_code: int | None
+    run_wall: float | None  # seconds the run took, on events ending one
+
+
+@dataclass
+class RunUsage:
+    """exit status and rusage of one job subprocess run."""
+
+    exit_code: int | None
+    utime: float
+    stime: float
+    maxrss: int  # kilobytes
+    wall_time: float
+    timed_out: bool = False
+
+
+@dataclass
+class HostCapacity:
+    """resources the workers of one host may hand out to declared jobs."""
+
+    cpus: float
+    memory_mb: int
@@ -0,0 +1,122 @@
+import functools
+import glob
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+PROFILE_DIR = "/tmp/queuectl_profiles"
+
+
+class PhaseTimer:
+    """
+    Accumulates wall time and call counts per named phase.
+
+    Only two perf_counter calls and a dict update per measurement, cheap
+    enough to leave switched on in every worker.
+    """
+
+    def __init__(self):
+        self.totals: dict[str, float] = defaultdict(float)
+        self.counts: dict[str, int] = defaultdict(int)
+
+    def add(self, name: str, seconds: float):
+        self.totals[name] += seconds
+        self.counts[name] += 1
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def snapshot(self) -> dict[str, dict[str, float]]:
+        return {
+            name: {"total": self.totals[name], "count": self.counts[name]}
+            for name in self.totals
+        }
+
+    def summary(self) -> str:
+        return ", ".join(
+            f"{name}={stats['total']:.3f}s/{stats['count']}"
+            for name, stats in sorted(self.snapshot().items())
+        )
+
+    def reset(self):
+        self.totals.clear()
+        self.counts.clear()
+
+
+# process wide timer, each worker is its own process
+phases = PhaseTimer()
+
+
+def timed(name: str):
+    """record every call of the decorated function under the given phase."""
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                phases.add(name, time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+def profile_call(worker_id: str, fn):
+    """
+    Run fn under cProfile and dump the stats and phase timings to PROFILE_DIR
+    as <worker_id>.prof and <worker_id>.phases.json.
+    """
+    import cProfile
+
+    phases.reset()
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+    try:
+        return fn()
+
+    finally:
+        profiler.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        profiler.dump_stats(os.path.join(PROFILE_DIR, f"{worker_id}.prof"))
+
+        with open(os.path.join(PROFILE_DIR, f"{worker_id}.phases.json"), "w") as f:
+            json.dump(phases.snapshot(), f)
+
+
+def profile_files(profile_dir: str = PROFILE_DIR) -> list[str]:
+    return sorted(glob.glob(os.path.join(profile_dir, "*.prof")))
+
+
+def clear_profiles(profile_dir: str = PROFILE_DIR) -> int:
+    paths = glob.glob(os.path.join(profile_dir, "*.prof"))
+    paths += glob.glob(os.path.join(profile_dir, "*.phases.json"))
+
+    for path in paths:
+        os.remove(path)
+
+    return len(paths)
+
+
+def merge_phases(profile_dir: str = PROFILE_DIR) -> dict[str, dict[str, float]]:
+    """sum the phase timings written by every profiled worker."""
+    merged: dict[str, dict[str, float]] = {}
+
+    for path in glob.glob(os.path.join(profile_dir, "*.phases.json")):
+        with open(path) as f:
+            for name, stats in json.load(f).items():
+                entry = merged.setdefault(name, {"total": 0.0, "count": 0})
+                entry["total"] += stats["total"]
+                entry["count"] += stats["count"]
+
+    return merged
@@ -1,45 +1,955 @@
-from datetime import datetime, timezone
-from db import get_conn
-from model import Job
-from typing import List, Dict
+from datetime import datetime, timedelta, timezone
+from db import APP_DIR, get_conn, shard_count, shard_for_job, shard_path
+from model import HostCapacity, Job, JobEvent, JobPayload, RunUsage
+from profiling import timed
+from typing import Callable, List, Dict
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import socket
+import sqlite3
+import time
+import zlib
 
+# rows touched per transaction by bulk operations, small enough that
+# workers waiting on the write lock are not stalled between chunks
+BULK_CHUNK_SIZE = 500
+BULK_CHUNK_PAUSE = 0.01
 
-def enqueue_job(command: str, max_retries: int | None = None) -> Job:
-    conn = get_conn()
+JOB_STATES = (
+    "pending",
+    "processing",
+    "completed",
+    "failed",
+    "dead",
+    "cancelled",
+    "waiting",  # map parents, until their chunks finish
+)
 
-    if max_retries is None:
-        cursor = conn.cursor()
-        cursor.execute("SELECT value FROM config WHERE key = 'max_retries'")
-        row = cursor.fetchone()
-        max_retries = int(row["value"]) if row else 3
+AGE_UNITS = {"s": "seconds", "m": "minutes", "h": "hours", "d": "days"}
+
+# phases of the latency report, named after the span of time they measure
+LATENCY_PHASES = (
+    "wait",  # pending until claimed
+    "retry_wait",  # failed until claimed again, backoff included
+    "run",  # started until completed, failed or dead
+    "end_to_end",  # enqueued until completed
+)
+
+# copies the spans of one attached shard into the report's temp table, the
+# rows never pass through Python
+LATENCY_SPANS_SQL = """
+    INSERT INTO spans (phase, seconds)
+    SELECT phase, seconds FROM (
+        SELECT CASE
+                   WHEN state = 'processing' AND prev_state = 'pending' THEN 'wait'
+                   WHEN state = 'processing' AND prev_state = 'failed' THEN 'retry_wait'
+                   WHEN prev_state = 'processing'
+                       AND state IN ('completed', 'failed', 'dead') THEN 'run'
+               END AS phase,
+               -- the worker's measurement leaves out prefetch buffering
+               CASE WHEN prev_state = 'processing'
+                   THEN coalesce(run_wall, seconds) ELSE seconds END AS seconds
+        FROM src.job_events
+        WHERE at >= ?
+    )
+    WHERE phase IS NOT NULL
+    UNION ALL
+    SELECT 'end_to_end',
+           (julianday(e.at) - julianday((
+               SELECT f.at FROM src.job_events f
+               WHERE f.job_id = e.job_id
+               ORDER BY f.id
+               LIMIT 1
+           ))) * 86400.0
+    FROM src.job_events e
+    WHERE e.state = 'completed' AND e.at >= ?
+"""
+
+# nearest-rank percentiles over the window-numbered spans of each phase
+LATENCY_REPORT_SQL = """
+    SELECT phase,
+           count(*) AS count,
+           avg(seconds) AS avg,
+           min(CASE WHEN rank >= 0.50 * n THEN seconds END) AS p50,
+           min(CASE WHEN rank >= 0.95 * n THEN seconds END) AS p95,
+           min(CASE WHEN rank >= 0.99 * n THEN seconds END) AS p99,
+           max(seconds) AS max
+    FROM (
+        SELECT phase, seconds,
+               row_number() OVER (PARTITION BY phase ORDER BY seconds) AS rank,
+               count(*) OVER (PARTITION BY phase) AS n
+        FROM spans
+    )
+    GROUP BY phase
+"""
+
+
+JOB_LIMIT_KEYS = ("timeout", "cpu_seconds", "max_rss", "nice")
+
+# declared needs used for admission, not enforced on the process
+JOB_RESOURCE_KEYS = ("cpus", "memory_mb")
+
+# stored in job_blobs instead of the jobs row
+JOB_PAYLOAD_KEYS = ("env", "stdin", "cwd")
+
+# longer commands move to the payload, the row keeps a preview for list/filters
+INLINE_COMMAND_LIMIT = 512
+
+# blobs smaller than this are not worth the zlib call
+COMPRESS_MIN_BYTES = 256
+
+# tail of stdout/stderr kept per run
+RESULT_MAX_CHARS = 64 * 1024
+
+# inputs of a map job run by one chunk (one claim, one shell) by default
+MAP_CHUNK_SIZE = 100
+
+# result cache limits per shard, read from config once per process
+_cache_limits: tuple[int, int] | None = None
+
+INSERT_JOB_COLUMNS = (
+    "id",
+    "command",
+    "state",
+    "attempts",
+    "max_retries",
+    "created_at",
+    "updated_at",
+    "timeout",
+    "cpu_seconds",
+    "max_rss",
+    "nice",
+    "cpus",
+    "memory_mb",
+    "has_payload",
+    "parent_id",
+    "map_total",
+    "exit_code",
+    "cache_ttl",
+    "cache_key",
+)
+
+INSERT_BLOB_SQL = """
+    INSERT OR REPLACE INTO job_blobs (job_id, kind, compressed, data)
+    VALUES(?, ?, ?, ?)
+"""
+
+INSERT_JOB_SQL = (
+    f"INSERT INTO jobs ({', '.join(INSERT_JOB_COLUMNS)}) "
+    f"VALUES({', '.join('?' for _ in INSERT_JOB_COLUMNS)})"
+)
+
+# serializes capacity checks and claims of all workers on this host
+ADMISSION_LOCK_PATH = os.path.join(APP_DIR, "admission.lock")
+
+# recorded on claimed jobs, admission only counts the jobs running here
+LOCAL_HOST = socket.gethostname()
+
+
+def parse_job_spec(data) -> dict:
+    """
+    Validate one decoded job JSON object and return the keyword arguments
+    for enqueue_job. Raises ValueError with a user facing message.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("Job JSON must be an object.")
+
+    command = data.get("command")
+
+    if not command:
+        raise ValueError("Job JSON must contain a 'command'.")
+
+    spec = {"command": command}
+
+    for key in JOB_LIMIT_KEYS:
+        value = data.get(key)
+        if value is None:
+            continue
+
+        if not isinstance(value, int) or isinstance(value, bool):
+            raise ValueError(f"'{key}' must be an integer.")
+
+        if key == "nice" and not 0 <= value <= 19:
+            raise ValueError("'nice' must be between 0 and 19.")
+
+        if key != "nice" and value <= 0:
+            raise ValueError(f"'{key}' must be positive.")
+
+        spec[key] = value
+
+    cpus = data.get("cpus")
+    if cpus is not None:
+        if not isinstance(cpus, (int, float)) or isinstance(cpus, bool) or cpus <= 0:
+            raise ValueError("'cpus' must be a positive number.")
+
+        spec["cpus"] = cpus
+
+    memory_mb = data.get("memory_mb")
+    if memory_mb is not None:
+        if not isinstance(memory_mb, int) or isinstance(memory_mb, bool):
+            raise ValueError("'memory_mb' must be a positive integer.")
+
+        if memory_mb <= 0:
+            raise ValueError("'memory_mb' must be a positive integer.")
+
+        spec["memory_mb"] = memory_mb
+
+    env = data.get("env")
+    if env is not None:
+        if not isinstance(env, dict) or not all(
+            isinstance(k, str) and isinstance(v, str) for k, v in env.items()
+        ):
+            raise ValueError("'env' must be an object of string values.")
+
+        spec["env"] = env
+
+    for key in ("stdin", "cwd"):
+        value = data.get(key)
+        if value is not None:
+            if not isinstance(value, str):
+                raise ValueError(f"'{key}' must be a string.")
+
+            spec[key] = value
+
+    if "map" in data or "map_file" in data:
+        spec["map"] = _parse_map_inputs(data)
+
+        if "stdin" in spec:
+            raise ValueError("'stdin' cannot be combined with 'map'.")
+
+        chunk_size = data.get("chunk_size", MAP_CHUNK_SIZE)
+        if not isinstance(chunk_size, int) or isinstance(chunk_size, bool):
+            raise ValueError("'chunk_size' must be a positive integer.")
+
+        if chunk_size <= 0:
+            raise ValueError("'chunk_size' must be a positive integer.")
+
+        spec["chunk_size"] = chunk_size
+
+    cache_ttl = data.get("cache_ttl")
+    if cache_ttl is not None:
+        if not isinstance(cache_ttl, int) or isinstance(cache_ttl, bool):
+            raise ValueError("'cache_ttl' must be a positive integer.")
+
+        if cache_ttl <= 0:
+            raise ValueError("'cache_ttl' must be a positive integer.")
+
+        if "map" in spec:
+            raise ValueError("'cache_ttl' cannot be combined with 'map'.")
+
+        spec["cache_ttl"] = cache_ttl
+
+    return spec
+
+
+def _parse_map_inputs(data: dict) -> list[str]:
+    if "map" in data and "map_file" in data:
+        raise ValueError("Use either 'map' or 'map_file', not both.")
+
+    if "map_file" in data:
+        try:
+            with open(data["map_file"]) as f:
+                inputs = [line.rstrip("\n") for line in f if line.strip()]
+
+        except (OSError, TypeError) as e:
+            raise ValueError(f"Cannot read 'map_file': {e}")
+
+    else:
+        inputs = data["map"]
+
+        if not isinstance(inputs, list) or not all(
+            isinstance(item, str) for item in inputs
+        ):
+            raise ValueError("'map' must be a list of strings.")
+
+    if not inputs:
+        raise ValueError("A map job needs at least one input.")
+
+    return inputs
+
+
+def _pack_blob(value) -> tuple[int, bytes]:
+    data = json.dumps(value, separators=(",", ":")).encode()
+
+    if len(data) >= COMPRESS_MIN_BYTES:
+        packed = zlib.compress(data)
+        if len(packed) < len(data):
+            return 1, packed
+
+    return 0, data
+
+
+def _unpack_blob(compressed: int, data: bytes):
+    return json.loads(zlib.decompress(data) if compressed else data)
+
+
+def _default_max_retries() -> int:
+    cursor = get_conn().cursor()
+    cursor.execute("SELECT value FROM config WHERE key = 'max_retries'")
+    row = cursor.fetchone()
+    return int(row["value"]) if row else 3
+
+
+def enqueue_job(
+    command: str,
+    max_retries: int | None = None,
+    timeout: int | None = None,
+    cpu_seconds: int | None = None,
+    max_rss: int | None = None,
+    nice: int | None = None,
+    cpus: float | None = None,
+    memory_mb: int | None = None,
+    env: dict[str, str] | None = None,
+    stdin: str | None = None,
+    cwd: str | None = None,
+) -> Job:
+    spec = {
+        "command": command,
+        "max_retries": max_retries,
+        "timeout": timeout,
+        "cpu_seconds": cpu_seconds,
+        "max_rss": max_rss,
+        "nice": nice,
+        "cpus": cpus,
+        "memory_mb": memory_mb,
+        "env": env,
+        "stdin": stdin,
+        "cwd": cwd,
+    }
+    return enqueue_jobs([spec])[0]
+
+
+def enqueue_jobs(specs: List[dict]) -> List[Job]:
+    """
+    Enqueue many jobs with one transaction per shard instead of one per job.
+    Each spec holds enqueue_job keyword arguments.
+    """
+    default_max_retries = None
+    jobs = []
+    by_shard: Dict[int, tuple[list, list, list, list]] = {}
+    now = datetime.now(timezone.utc)
+
+    for spec in specs:
+        spec = dict(spec)
+        payload = {}
+
+        for key in JOB_PAYLOAD_KEYS:
+            value = spec.pop(key, None)
+            if value is not None:
+                payload[key] = value
+
+        if spec.get("cache_ttl") is not None:
+            spec["cache_key"] = _cache_key(spec["command"], payload)
+
+        if len(spec["command"]) > INLINE_COMMAND_LIMIT:
+            payload["command"] = spec["command"]
+            spec["command"] = spec["command"][: INLINE_COMMAND_LIMIT - 1] + "…"
+
+        if spec.get("max_retries") is None:
+            if default_max_retries is None:
+                default_max_retries = _default_max_retries()
+
+            spec["max_retries"] = default_max_retries
+
+        inputs = spec.pop("map", None)
+        chunk_size = spec.pop("chunk_size", MAP_CHUNK_SIZE)
+
+        if inputs is None:
+            job = Job(**spec, has_payload=int(bool(payload)))
+
+        else:
+            job = Job(
+                **spec,
+                state="waiting",
+                has_payload=int(bool(payload)),
+                map_total=len(inputs),
+            )
+
+        # identical cacheable jobs share a shard, and with it the cache entry
+        job.shard = shard_for_job(job.cache_key or job.id)
+        jobs.append(job)
+
+        rows, blobs, items, hits = by_shard.setdefault(job.shard, ([], [], [], []))
+
+        if job.cache_key is not None:
+            exit_code = _cached_exit_code(job.shard, job.cache_key, job.cache_ttl, now)
+
+            if exit_code is not None:
+                job.state = "completed"
+                job.exit_code = exit_code
+                hits.append((job.id, job.cache_key))
+
+        rows.append(tuple(getattr(job, column) for column in INSERT_JOB_COLUMNS))
+
+        if payload:
+            blobs.append((job.id, "payload", *_pack_blob(payload)))
 
-    job = Job(command=command, max_retries=max_retries)
+        if inputs is None:
+            continue
 
-    job.updated_at = datetime.now(timezone.utc).isoformat()
+        # chunks stay in the parent's shard so the rollup triggers can see them,
+        # they share the parent's payload instead of copying it
+        for start in range(0, len(inputs), chunk_size):
+            chunk = Job(**spec, has_payload=job.has_payload, parent_id=job.id)
+            rows.append(tuple(getattr(chunk, column) for column in INSERT_JOB_COLUMNS))
+            items.extend(
+                (chunk.id, idx, inputs[idx])
+                for idx in range(start, min(start + chunk_size, len(inputs)))
+            )
+
+    for shard, (rows, blobs, items, hits) in by_shard.items():
+        conn = get_conn(shard)
+
+        with conn:
+            conn.executemany(INSERT_JOB_SQL, rows)
+
+            if blobs:
+                conn.executemany(INSERT_BLOB_SQL, blobs)
+
+            if items:
+                conn.executemany(
+                    "INSERT INTO map_items (chunk_id, idx, input) VALUES(?, ?, ?)",
+                    items,
+                )
+
+            if hits:
+                _record_cache_hits(conn, hits, now.isoformat())
+
+    return jobs
+
+
+def _cache_key(command: str, payload: dict) -> str:
+    """hash of everything that determines the job's result."""
+    inputs = {"command": command, **payload}
+    data = json.dumps(inputs, sort_keys=True, separators=(",", ":")).encode()
+    return hashlib.sha256(data).hexdigest()
+
+
+def _cached_exit_code(
+    shard: int, cache_key: str, cache_ttl: int, now: datetime
+) -> int | None:
+    cutoff = (now - timedelta(seconds=cache_ttl)).isoformat()
+    row = (
+        get_conn(shard)
+        .execute(
+            "SELECT exit_code FROM job_cache WHERE cache_key = ? AND created_at >= ?",
+            (cache_key, cutoff),
+        )
+        .fetchone()
+    )
+    return None if row is None else row["exit_code"]
+
+
+def _record_cache_hits(
+    conn, hits: list[tuple[str, str]], now: str, count: bool = True
+):
+    """copy the cached output to the completed jobs and refresh the LRU order."""
+    conn.executemany(
+        """
+        INSERT OR REPLACE INTO job_blobs (job_id, kind, compressed, data)
+        SELECT ?, 'result', compressed, result FROM job_cache
+        WHERE cache_key = ? AND result IS NOT NULL
+        """,
+        hits,
+    )
+    conn.executemany(
+        "UPDATE job_cache SET last_used_at = ? WHERE cache_key = ?",
+        [(now, cache_key) for _, cache_key in hits],
+    )
+    if count:
+        conn.execute(
+            "UPDATE cache_stats SET value = value + ? WHERE name = 'hits'", (len(hits),)
+        )
+
+
+def complete_from_cache(job: Job) -> bool:
+    """
+    Complete a claimed job with a cached result stored after it was
+    enqueued, e.g. by an identical job that was still running back then.
+
+    This is the last lookup before the job runs, so the first claim counts
+    the job's cache miss. Retries look up again without counting, each job
+    is one hit or one miss in the stats.
+    """
+    now = datetime.now(timezone.utc)
+    conn = get_conn(job.shard)
+    first_claim = job.attempts <= 1
 
     with conn:
+        exit_code = _cached_exit_code(job.shard, job.cache_key, job.cache_ttl, now)
+
+        if exit_code is None:
+            if first_claim:
+                conn.execute(
+                    "UPDATE cache_stats SET value = value + 1 WHERE name = 'misses'"
+                )
+
+            return False
+
+        _record_cache_hits(
+            conn, [(job.id, job.cache_key)], now.isoformat(), count=first_claim
+        )
         conn.execute(
             """
-            INSERT INTO jobs (id, command, state, attempts, max_retries, created_at, updated_at)
-            VALUES(?, ?, ?, ?, ?, ?, ?)
+            UPDATE jobs
+            SET state = 'completed', updated_at = ?, next_run_time = NULL,
+                exit_code = ?, run_wall = NULL
+            WHERE id = ?
+            """,
+            (now.isoformat(), exit_code, job.id),
+        )
+
+    return True
+
+
+def _get_cache_limits() -> tuple[int, int]:
+    """(max entries, max bytes) of each shard's cache."""
+    global _cache_limits
+
+    if _cache_limits is None:
+        rows = get_conn().execute(
+            """
+            SELECT key, value FROM config
+            WHERE key IN ('cache_max_entries', 'cache_max_mb')
+            """
+        )
+        config = {row["key"]: int(row["value"]) for row in rows}
+        _cache_limits = (
+            config.get("cache_max_entries", 10000),
+            config.get("cache_max_mb", 64) * 1024 * 1024,
+        )
+
+    return _cache_limits
+
+
+def _store_cached_result(
+    conn, cache_key: str, exit_code: int, result: tuple[int, bytes] | None, now: str
+):
+    compressed, data = result or (0, None)
+    conn.execute(
+        """
+        INSERT INTO job_cache
+            (cache_key, exit_code, compressed, result, size, created_at, last_used_at)
+        VALUES(?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(cache_key) DO UPDATE SET
+            exit_code = excluded.exit_code, compressed = excluded.compressed,
+            result = excluded.result, size = excluded.size,
+            created_at = excluded.created_at, last_used_at = excluded.last_used_at
+        """,
+        (cache_key, exit_code, compressed, data, len(data or b""), now, now),
+    )
+
+    max_entries, max_bytes = _get_cache_limits()
+
+    while True:
+        stats = dict(
+            conn.execute(
+                "SELECT name, value FROM cache_stats WHERE name IN ('entries', 'bytes')"
+            ).fetchall()
+        )
+
+        if stats["entries"] <= max_entries and stats["bytes"] <= max_bytes:
+            break
+
+        # least recently used first, one at a time while only the bytes are over,
+        # a single result adds at most 2 * RESULT_MAX_CHARS
+        cursor = conn.execute(
+            """
+            DELETE FROM job_cache WHERE rowid IN (
+                SELECT rowid FROM job_cache ORDER BY last_used_at LIMIT ?
+            )
+            """,
+            (max(stats["entries"] - max_entries, 1),),
+        )
+
+        if cursor.rowcount == 0:
+            break
+
+
+def get_cache_stats() -> Dict[str, int]:
+    """hits, misses, entries and bytes of the result cache, summed over shards."""
+    stats = dict.fromkeys(("hits", "misses", "entries", "bytes"), 0)
+
+    for shard in range(shard_count()):
+        for row in get_conn(shard).execute("SELECT name, value FROM cache_stats"):
+            stats[row["name"]] += row["value"]
+
+    return stats
+
+
+def clear_cache() -> int:
+    """drop every cached result, the hit/miss counters are kept."""
+    total = 0
+
+    for shard in range(shard_count()):
+        conn = get_conn(shard)
+
+        with conn:
+            total += conn.execute("DELETE FROM job_cache").rowcount
+
+    return total
+
+
+def load_payload(job: Job) -> JobPayload | None:
+    """fetch the out-of-row payload of a job, None when it has none. Chunks read their parent's."""
+    if not job.has_payload:
+        return None
+
+    row = (
+        get_conn(job.shard)
+        .execute(
+            """
+            SELECT compressed, data FROM job_blobs
+            WHERE job_id = ? AND kind = 'payload'
+            """,
+            (job.parent_id or job.id,),
+        )
+        .fetchone()
+    )
+
+    if row is None:
+        return None
+
+    return JobPayload(**_unpack_blob(row["compressed"], row["data"]))
+
+
+def load_result(job_id: str) -> dict[str, str] | None:
+    """stdout/stderr stored for the last run of a job, searching every shard."""
+    for shard in range(shard_count()):
+        row = (
+            get_conn(shard)
+            .execute(
+                """
+                SELECT compressed, data FROM job_blobs
+                WHERE job_id = ? AND kind = 'result'
+                """,
+                (job_id,),
+            )
+            .fetchone()
+        )
+
+        if row is not None:
+            return _unpack_blob(row["compressed"], row["data"])
+
+    return None
+
+
+def load_map_items(job: Job) -> list[tuple[int, str]]:
+    """(idx, input) of the chunk's inputs that have not succeeded yet."""
+    cursor = get_conn(job.shard).execute(
+        """
+        SELECT idx, input FROM map_items
+        WHERE chunk_id = ? AND (exit_code IS NULL OR exit_code != 0)
+        ORDER BY idx
+        """,
+        (job.id,),
+    )
+    return [(row["idx"], row["input"]) for row in cursor.fetchall()]
+
+
+def get_map_progress(
+    parent_id: str, failed_limit: int = 20
+) -> tuple[Job, Dict[str, int], list[tuple[int, str, int]]] | None:
+    """
+    The parent of a map job, its input counts (succeeded, failed, not run)
+    and the first failed inputs as (idx, input, exit_code). None when
+    parent_id is not a map job.
+    """
+    for shard in range(shard_count()):
+        conn = get_conn(shard)
+        row = conn.execute(
+            "SELECT * FROM jobs WHERE id = ? AND map_total IS NOT NULL", (parent_id,)
+        ).fetchone()
+
+        if row is None:
+            continue
+
+        counts = conn.execute(
+            """
+            SELECT coalesce(sum(exit_code = 0), 0) AS succeeded,
+                   coalesce(sum(exit_code != 0), 0) AS failed,
+                   coalesce(sum(exit_code IS NULL), 0) AS not_run
+            FROM map_items
+            WHERE chunk_id IN (SELECT id FROM jobs WHERE parent_id = ?)
             """,
-            (
-                job.id,
-                job.command,
-                job.state,
-                job.attempts,
-                job.max_retries,
-                job.created_at,
-                job.updated_at,
-            ),
+            (parent_id,),
+        ).fetchone()
+
+        failed = conn.execute(
+            """
+            SELECT idx, input, exit_code FROM map_items
+            WHERE chunk_id IN (SELECT id FROM jobs WHERE parent_id = ?)
+                AND exit_code != 0
+            ORDER BY idx
+            LIMIT ?
+            """,
+            (parent_id, failed_limit),
+        ).fetchall()
+
+        return (
+            Job.row_to_job(row, shard),
+            dict(counts),
+            [(item["idx"], item["input"], item["exit_code"]) for item in failed],
+        )
+
+    return None
+
+
+def job_history(job_id: str) -> List[JobEvent]:
+    """every recorded state change of a job, oldest first."""
+    # chunks and cacheable jobs are not stored in the shard their id hashes to
+    home = shard_for_job(job_id)
+    shards = [home] + [shard for shard in range(shard_count()) if shard != home]
+
+    for shard in shards:
+        cursor = get_conn(shard).execute(
+            """
+            SELECT job_id, at, state, prev_state, seconds, attempt, worker_id,
+                   exit_code, run_wall
+            FROM job_events
+            WHERE job_id = ?
+            ORDER BY id
+            """,
+            (job_id,),
         )
+        rows = cursor.fetchall()
+
+        if rows:
+            return [JobEvent(**dict(row)) for row in rows]
+
+    return []
+
+
+def count_events(before: str) -> int:
+    return sum(
+        get_conn(shard)
+        .execute("SELECT count(*) FROM job_events WHERE at < ?", (before,))
+        .fetchone()[0]
+        for shard in range(shard_count())
+    )
+
+
+def prune_events(
+    before: str,
+    chunk_size: int = BULK_CHUNK_SIZE,
+    on_progress: Callable[[int], None] | None = None,
+) -> int:
+    """
+    Delete the history recorded before `before`, oldest first, one chunk per
+    transaction. Jobs still running past the cutoff lose their early events,
+    so their end-to-end span is measured from the oldest event left.
+    """
+    total = 0
+
+    for shard in range(shard_count()):
+        conn = get_conn(shard)
+
+        while True:
+            with conn:
+                deleted = conn.execute(
+                    """
+                    DELETE FROM job_events
+                    WHERE id IN (
+                        SELECT id FROM job_events
+                        WHERE at < ?
+                        ORDER BY at
+                        LIMIT ?
+                    )
+                    """,
+                    (before, chunk_size),
+                ).rowcount
+
+            total += deleted
 
-    return job
+            if on_progress is not None and deleted:
+                on_progress(deleted)
 
+            if deleted < chunk_size:
+                break
 
-def fetch_job_atomically() -> Job | None:
-    conn = get_conn()
+            # let waiting workers take the write lock between chunks
+            time.sleep(BULK_CHUNK_PAUSE)
+
+    return total
+
+
+def latency_report(since: str) -> Dict[str, Dict[str, float]]:
+    """
+    Count, mean, p50/p95/p99 and max seconds of each of LATENCY_PHASES over
+    the events recorded since `since`. Percentiles need every span at once,
+    so the shards are attached one by one to an in-memory database and their
+    spans gathered there before aggregating.
+    """
+    conn = sqlite3.connect(":memory:")
+    conn.row_factory = sqlite3.Row
+
+    try:
+        conn.execute("CREATE TABLE spans (phase TEXT NOT NULL, seconds REAL)")
+
+        for shard in range(shard_count()):
+            conn.execute("ATTACH DATABASE ? AS src", (shard_path(shard),))
+
+            with conn:
+                conn.execute(LATENCY_SPANS_SQL, (since, since))
+
+            conn.execute("DETACH DATABASE src")
+
+        report = {row["phase"]: dict(row) for row in conn.execute(LATENCY_REPORT_SQL)}
+
+    finally:
+        conn.close()
+
+    return {phase: report[phase] for phase in LATENCY_PHASES if phase in report}
+
+
+@timed("claim")
+def fetch_job_atomically(
+    home_shard: int = 0,
+    worker_id: str | None = None,
+    capacity: HostCapacity | None = None,
+    reserved: tuple[float, int] | None = None,
+    host: str | None = None,
+) -> Job | None:
+    """
+    Claim the oldest eligible job, trying the worker's home shard first and
+    stealing from the other shards when it is empty.
+
+    With a capacity, only jobs whose declared cpus/memory_mb fit into what
+    the running jobs of the claiming host (this one unless `host` is given)
+    leave free are claimed. `reserved` replaces those running jobs, for
+    callers that admit jobs for another host.
+
+    While no runnable or running job declares resources, claims skip the
+    host-wide admission lock and only take undeclared jobs, which never
+    need it, so a declared job enqueued meanwhile waits for a locked claim.
+    """
     now = datetime.now(timezone.utc).isoformat()
+    claim = (home_shard, now, worker_id, host or LOCAL_HOST)
+
+    if capacity is None:
+        return _claim_any(*claim, (float("inf"), float("inf")))
+
+    if reserved is not None:
+        return _claim_any(*claim, _free_capacity(capacity, reserved))
+
+    if not _declared_jobs_exist():
+        return _claim_any(*claim, (0, 0))
+
+    with _admission_lock():
+        return _claim_any(*claim, _free_capacity(capacity, host=host or LOCAL_HOST))
+
+
+@contextmanager
+def _admission_lock():
+    # opened per call, a descriptor inherited across fork would share the lock
+    with open(ADMISSION_LOCK_PATH, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _declared_jobs_exist() -> bool:
+    """whether a runnable or running job declares cpus/memory_mb, read from a partial index."""
+    for shard in range(shard_count()):
+        row = (
+            get_conn(shard)
+            .execute(
+                """
+                SELECT 1 FROM jobs
+                WHERE (cpus IS NOT NULL OR memory_mb IS NOT NULL)
+                    AND state IN ('pending', 'failed', 'processing')
+                LIMIT 1
+                """
+            )
+            .fetchone()
+        )
+
+        if row is not None:
+            return True
+
+    return False
+
+
+def reserved_resources(host: str | None = None) -> tuple[float, int]:
+    """
+    cpus and memory_mb declared by the jobs currently processing on a host,
+    this one by default. Rows claimed before hosts were recorded count here.
+    """
+    cpus, memory_mb = 0.0, 0
+
+    for shard in range(shard_count()):
+        row = (
+            get_conn(shard)
+            .execute(
+                """
+                SELECT coalesce(sum(cpus), 0) AS cpus,
+                       coalesce(sum(memory_mb), 0) AS memory_mb
+                FROM jobs
+                WHERE state = 'processing' AND (host = ? OR host IS NULL)
+                """,
+                (host or LOCAL_HOST,),
+            )
+            .fetchone()
+        )
+        cpus += row["cpus"]
+        memory_mb += row["memory_mb"]
+
+    return cpus, memory_mb
+
+
+def _free_capacity(
+    capacity: HostCapacity,
+    reserved: tuple[float, int] | None = None,
+    host: str | None = None,
+) -> tuple[float, float]:
+    used_cpus, used_memory_mb = reserved or reserved_resources(host)
+
+    # a job larger than the whole host would never fit, let it run alone
+    if used_cpus == 0 and used_memory_mb == 0:
+        return float("inf"), float("inf")
+
+    return (
+        max(capacity.cpus - used_cpus, 0),
+        max(capacity.memory_mb - used_memory_mb, 0),
+    )
+
+
+def _claim_any(
+    home_shard: int,
+    now: str,
+    worker_id: str | None,
+    host: str,
+    free: tuple[float, float],
+) -> Job | None:
+    shards = shard_count()
+
+    for offset in range(shards):
+        job = _claim_from_shard(
+            (home_shard + offset) % shards, now, worker_id, host, free
+        )
+
+        if job is not None:
+            return job
+
+    return None
+
+
+def _claim_from_shard(
+    shard: int,
+    now: str,
+    worker_id: str | None,
+    host: str,
+    free: tuple[float, float],
+) -> Job | None:
+    conn = get_conn(shard)
+    free_cpus, free_memory_mb = free
 
     with conn:
         cursor = conn.cursor()
@@ -47,10 +957,11 @@ def fetch_job_atomically() -> Job | None:
             """
             SELECT id FROM jobs
             WHERE (state = 'pending' OR (state = 'failed' AND next_run_time <= ?))
+                AND coalesce(cpus, 0) <= ? AND coalesce(memory_mb, 0) <= ?
             ORDER BY created_at
             LIMIT 1
             """,
-            (now,),
+            (now, free_cpus, free_memory_mb),
         )
 
         row = cursor.fetchone()
@@ -63,88 +974,278 @@ def fetch_job_atomically() -> Job | None:
         cursor.execute(
             """
             UPDATE jobs
-            SET state = 'processing', updated_at = ?, attempts = attempts + 1
+            SET state = 'processing', updated_at = ?, attempts = attempts + 1,
+                worker_id = ?, host = ?
             WHERE id = ? AND (state = 'pending' OR (state = 'failed' AND next_run_time <= ?))
             RETURNING *
             """,
-            (now, job_id, now),
+            (now, worker_id, host, job_id, now),
         )
 
         locked_job_row = cursor.fetchone()
         if locked_job_row:
-            return Job.row_to_job(locked_job_row)
+            return Job.row_to_job(locked_job_row, shard)
 
     return None
 
 
-def update_job_state(job_id: str, state: str, next_run_time: str | None = None):
-    conn = get_conn()
+@timed("update")
+def update_job_state(
+    job_id: str,
+    state: str,
+    next_run_time: str | None = None,
+    usage: RunUsage | None = None,
+    shard: int = 0,
+    output: tuple[str, str] | None = None,
+    item_results: Dict[int, int] | None = None,
+    cache_key: str | None = None,
+):
+    """
+    Record the outcome of a run. With a cache_key a successful result is
+    stored for identical jobs.
+    """
+    conn = get_conn(shard)
     now = datetime.now(timezone.utc).isoformat()
+    result = None
+
     with conn:
-        conn.execute(
-            "UPDATE jobs SET state = ?, updated_at = ?, next_run_time = ? WHERE id = ?",
-            (state, now, next_run_time, job_id),
-        )
+        # per-input exit codes of a map chunk, before the state change fires the rollup
+        if item_results:
+            conn.executemany(
+                "UPDATE map_items SET exit_code = ? WHERE chunk_id = ? AND idx = ?",
+                [(code, job_id, idx) for idx, code in item_results.items()],
+            )
 
+        # written in the same transaction as the state change, no extra commit
+        if output is not None and any(output):
+            stdout, stderr = output
+            result = _pack_blob(
+                {
+                    "stdout": stdout[-RESULT_MAX_CHARS:],
+                    "stderr": stderr[-RESULT_MAX_CHARS:],
+                }
+            )
+            conn.execute(INSERT_BLOB_SQL, (job_id, "result", *result))
 
-def get_status_summary() -> Dict[str, int]:
-    conn = get_conn()
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-        SELECT state, count(id) as count
-        FROM jobs
-        GROUP By state
-        """
+        elif output is not None:
+            conn.execute(
+                "DELETE FROM job_blobs WHERE job_id = ? AND kind = 'result'", (job_id,)
+            )
+
+        if usage is None:
+            conn.execute(
+                """
+                UPDATE jobs
+                SET state = ?, updated_at = ?, next_run_time = ?, run_wall = NULL
+                WHERE id = ?
+                """,
+                (state, now, next_run_time, job_id),
+            )
+
+        else:
+            conn.execute(
+                """
+                UPDATE jobs
+                SET state = ?, updated_at = ?, next_run_time = ?,
+                    exit_code = ?, run_utime = ?, run_stime = ?, run_maxrss = ?,
+                    run_wall = ?
+                WHERE id = ?
+                """,
+                (
+                    state,
+                    now,
+                    next_run_time,
+                    usage.exit_code,
+                    usage.utime,
+                    usage.stime,
+                    usage.maxrss,
+                    usage.wall_time,
+                    job_id,
+                ),
+            )
+
+        if cache_key is not None and state == "completed":
+            _store_cached_result(conn, cache_key, 0, result, now)
+
+
+def fail_job(
+    job: Job,
+    backoff_base: int,
+    usage: RunUsage | None = None,
+    output: tuple[str, str] | None = None,
+    item_results: Dict[int, int] | None = None,
+) -> int | None:
+    """
+    Schedule a retry with exponential backoff, or move the job to the DLQ once
+    it used up its retries. Returns the backoff delay in seconds, None when
+    the job went to the DLQ.
+    """
+    if job.attempts >= job.max_retries:
+        update_job_state(
+            job.id,
+            "dead",
+            next_run_time=None,
+            usage=usage,
+            shard=job.shard,
+            output=output,
+            item_results=item_results,
+            cache_key=job.cache_key,
+        )
+        return None
+
+    delay_seconds = backoff_base**job.attempts
+    retry_time = datetime.now(timezone.utc) + timedelta(seconds=delay_seconds)
+    update_job_state(
+        job.id,
+        "failed",
+        next_run_time=retry_time.isoformat(),
+        usage=usage,
+        shard=job.shard,
+        output=output,
+        item_results=item_results,
+        cache_key=job.cache_key,
     )
+    return delay_seconds
 
-    rows = cursor.fetchall()
 
-    summary = {
-        "pending": 0,
-        "processing": 0,
-        "completed": 0,
-        "failed": 0,
-        "dead": 0,
-    }
+def get_status_summary() -> Dict[str, int]:
+    summary = dict.fromkeys(JOB_STATES, 0)
 
-    for row in rows:
-        if row["state"] in summary:
-            summary[row["state"]] = row["count"]
+    for shard in range(shard_count()):
+        cursor = get_conn(shard).cursor()
+        cursor.execute("SELECT state, count FROM state_counts")
+
+        for row in cursor.fetchall():
+            if row["state"] in summary:
+                summary[row["state"]] += row["count"]
 
     return summary
 
 
-def list_jobs_by_state(state: str) -> List[Job]:
-    conn = get_conn()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM jobs WHERE state = ? ORDER BY  created_at", (state,))
+def list_jobs_by_state(state: str, limit: int | None = None) -> List[Job]:
+    per_shard = []
 
-    rows = cursor.fetchall()
-    return [Job.row_to_job(row) for row in rows]
+    for shard in range(shard_count()):
+        cursor = get_conn(shard).cursor()
+        # the oldest `limit` jobs overall are among the oldest `limit` of each
+        # shard, a negative LIMIT is no limit
+        cursor.execute(
+            "SELECT * FROM jobs WHERE state = ? ORDER BY created_at LIMIT ?",
+            (state, -1 if limit is None else limit),
+        )
+        per_shard.append([Job.row_to_job(row, shard) for row in cursor.fetchall()])
 
+    # each shard is already sorted, so a k-way merge keeps the global order
+    merged = heapq.merge(*per_shard, key=lambda job: job.created_at)
+    return list(itertools.islice(merged, limit))
 
-def retry_dead_job(job_id: str) -> bool:
-    conn = get_conn()
 
-    with conn:
-        cursor = conn.cursor()
-        cursor.execute(
+def inflight_by_worker() -> Dict[str, int]:
+    """number of processing jobs per claiming worker."""
+    inflight: Dict[str, int] = {}
+
+    for shard in range(shard_count()):
+        cursor = get_conn(shard).execute(
             """
-            UPDATE jobs
-            SET state = 'pending', attempts = 0, updated_at = ?, next_run_time = NULL
-            WHERE id = ? AND state = 'dead'
-            """,
-            (datetime.now(timezone.utc).isoformat(), job_id),
+            SELECT worker_id, count(*) AS count
+            FROM jobs
+            WHERE state = 'processing'
+            GROUP BY worker_id
+            """
+        )
+
+        for row in cursor.fetchall():
+            worker = row["worker_id"] or "unknown"
+            inflight[worker] = inflight.get(worker, 0) + row["count"]
+
+    return inflight
+
+
+def oldest_ready_time() -> str | None:
+    """
+    Since when the longest waiting runnable job has been ready, either its
+    creation time (pending) or its backoff expiry (failed).
+    """
+    now = datetime.now(timezone.utc).isoformat()
+    oldest = None
+
+    for shard in range(shard_count()):
+        row = (
+            get_conn(shard)
+            .execute(
+                """
+                SELECT min(ready) AS ready FROM (
+                    SELECT min(created_at) AS ready FROM jobs WHERE state = 'pending'
+                    UNION ALL
+                    SELECT min(next_run_time) FROM jobs
+                    WHERE state = 'failed' AND next_run_time <= ?
+                )
+                """,
+                (now,),
+            )
+            .fetchone()
         )
 
-    return cursor.rowcount > 0
+        if row["ready"] is not None and (oldest is None or row["ready"] < oldest):
+            oldest = row["ready"]
+
+    return oldest
+
+
+def recent_failures(since: str | None = None, limit: int = 10) -> List[Job]:
+    """
+    Failed or dead jobs updated after `since`, newest first. Each state is
+    read through the (state, updated_at) index, so only changed rows are
+    touched no matter how large the DLQ is.
+    """
+    per_query = []
+
+    for shard in range(shard_count()):
+        for state in ("failed", "dead"):
+            cursor = get_conn(shard).execute(
+                """
+                SELECT * FROM jobs
+                WHERE state = ? AND updated_at > ?
+                ORDER BY updated_at DESC
+                LIMIT ?
+                """,
+                (state, since or "", limit),
+            )
+            per_query.append([Job.row_to_job(row, shard) for row in cursor.fetchall()])
+
+    merged = heapq.merge(*per_query, key=lambda job: job.updated_at, reverse=True)
+    return list(merged)[:limit]
+
+
+def _update_one_job(statement: str, params: tuple) -> bool:
+    """run an id-based statement against each shard until one matches."""
+    for shard in range(shard_count()):
+        conn = get_conn(shard)
+
+        with conn:
+            cursor = conn.execute(statement, params)
+
+        if cursor.rowcount > 0:
+            return True
 
+    return False
+
+
+def retry_dead_job(job_id: str) -> bool:
+    return _update_one_job(
+        """
+        UPDATE jobs
+        SET state = 'pending', attempts = 0, updated_at = ?, next_run_time = NULL
+        WHERE id = ? AND state = 'dead'
+        """,
+        (datetime.now(timezone.utc).isoformat(), job_id),
+    )
+
+
+def requeue_interrupted_job(job_id: str, current_attempts: int, shard: int = 0):
+    conn = get_conn(shard)
+    new_attempts = max(0, current_attempts - 1)
 
-def requeue_interrupted_job(job_id: str, current_attempts: int):
-    conn = get_conn()
-    new_attempts = max(0, current_attempts - 1) 
-    
     with conn:
         conn.execute(
             """
@@ -152,8 +1253,243 @@ def requeue_interrupted_job(job_id: str, current_attempts: int):
             SET state = 'pending',
                 attempts = ?,
                 updated_at = ?,
-                next_run_time = NULL
+                next_run_time = NULL,
+                run_wall = NULL
             WHERE id = ? AND state = 'processing'
             """,
-            (new_attempts, datetime.utcnow().isoformat(), job_id)
-        )
\ No newline at end of file
+            (new_attempts, datetime.now(timezone.utc).isoformat(), job_id),
+        )
+
+
+def parse_since(value: str) -> str:
+    """
+    Turn an age such as '30m' or '2d', or an ISO timestamp, into the UTC ISO
+    string used for the timestamp columns. Raises ValueError.
+    """
+    unit = AGE_UNITS.get(value[-1:])
+
+    if unit is not None and value[:-1].isdigit():
+        cutoff = datetime.now(timezone.utc) - timedelta(**{unit: int(value[:-1])})
+
+    else:
+        try:
+            cutoff = datetime.fromisoformat(value)
+
+        except ValueError:
+            raise ValueError(f"Invalid --since value '{value}'.")
+
+        if cutoff.tzinfo is None:
+            cutoff = cutoff.replace(tzinfo=timezone.utc)
+
+    return cutoff.astimezone(timezone.utc).isoformat()
+
+
+def _job_filter(
+    state: str,
+    since: str | None = None,
+    command_like: str | None = None,
+    top_level: bool = False,
+) -> tuple[str, list]:
+    clauses = ["state = ?"]
+    params: list = [state]
+
+    if top_level:
+        # leave map chunks to their parent
+        clauses.append("parent_id IS NULL")
+
+    if since is not None:
+        clauses.append("updated_at >= ?")
+        params.append(since)
+
+    if command_like is not None:
+        clauses.append("command LIKE ?")
+        params.append(command_like)
+
+    return " AND ".join(clauses), params
+
+
+def count_jobs(
+    state: str,
+    since: str | None = None,
+    command_like: str | None = None,
+    top_level: bool = False,
+) -> int:
+    where, params = _job_filter(state, since, command_like, top_level)
+    total = 0
+
+    for shard in range(shard_count()):
+        row = get_conn(shard).execute(
+            f"SELECT count(*) AS count FROM jobs WHERE {where}", params
+        )
+        total += row.fetchone()["count"]
+
+    return total
+
+
+def count_shard_jobs(shard: int) -> int:
+    row = get_conn(shard).execute("SELECT count(*) AS count FROM jobs")
+    return row.fetchone()["count"]
+
+
+def _run_chunked(
+    statement: str,
+    statement_params: Callable[[], list],
+    where: str,
+    params: list,
+    chunk_size: int,
+    on_progress: Callable[[int], None] | None,
+) -> int:
+    """
+    Apply a set-based UPDATE/DELETE to the filtered rows, one chunk per transaction.
+
+    Chunks walk the table in rowid order so each one resumes where the last
+    stopped instead of rescanning rows that were already handled. Shards are
+    processed one after another.
+    """
+    total = 0
+
+    for shard in range(shard_count()):
+        total += _run_chunked_shard(
+            shard, statement, statement_params, where, params, chunk_size, on_progress
+        )
+
+    return total
+
+
+def _run_chunked_shard(
+    shard: int,
+    statement: str,
+    statement_params: Callable[[], list],
+    where: str,
+    params: list,
+    chunk_size: int,
+    on_progress: Callable[[int], None] | None,
+) -> int:
+    conn = get_conn(shard)
+    last_rowid = 0
+    total = 0
+
+    while True:
+        with conn:
+            cursor = conn.execute(
+                f"""
+                {statement}
+                WHERE rowid IN (
+                    SELECT rowid FROM jobs
+                    WHERE {where} AND rowid > ?
+                    ORDER BY rowid
+                    LIMIT ?
+                )
+                RETURNING rowid
+                """,
+                [*statement_params(), *params, last_rowid, chunk_size],
+            )
+            rowids = [row[0] for row in cursor.fetchall()]
+
+        if not rowids:
+            break
+
+        total += len(rowids)
+        last_rowid = max(rowids)
+
+        if on_progress is not None:
+            on_progress(len(rowids))
+
+        if len(rowids) < chunk_size:
+            break
+
+        # let waiting workers take the write lock between chunks
+        time.sleep(BULK_CHUNK_PAUSE)
+
+    return total
+
+
+def retry_dead_jobs(
+    since: str | None = None,
+    command_like: str | None = None,
+    chunk_size: int = BULK_CHUNK_SIZE,
+    on_progress: Callable[[int], None] | None = None,
+) -> int:
+    where, params = _job_filter("dead", since, command_like)
+    return _run_chunked(
+        """
+        UPDATE jobs
+        SET state = 'pending', attempts = 0, updated_at = ?, next_run_time = NULL
+        """,
+        lambda: [datetime.now(timezone.utc).isoformat()],
+        where,
+        params,
+        chunk_size,
+        on_progress,
+    )
+
+
+def purge_dead_jobs(
+    since: str | None = None,
+    command_like: str | None = None,
+    chunk_size: int = BULK_CHUNK_SIZE,
+    on_progress: Callable[[int], None] | None = None,
+) -> int:
+    # a purged parent takes its chunks along, a purged chunk alone would
+    # leave a retried parent waiting on it forever
+    where, params = _job_filter("dead", since, command_like, top_level=True)
+    return _run_chunked(
+        "DELETE FROM jobs", lambda: [], where, params, chunk_size, on_progress
+    )
+
+
+def purge_dead_job(job_id: str) -> bool:
+    """delete one dead job. Raises ValueError for a map chunk, its parent must be purged."""
+    for shard in range(shard_count()):
+        row = (
+            get_conn(shard)
+            .execute(
+                "SELECT parent_id FROM jobs WHERE id = ? AND parent_id IS NOT NULL",
+                (job_id,),
+            )
+            .fetchone()
+        )
+
+        if row is not None:
+            raise ValueError(
+                f"Job {job_id} is a chunk of map job {row['parent_id']}, "
+                "purge the parent instead."
+            )
+
+    return _update_one_job(
+        "DELETE FROM jobs WHERE id = ? AND state = 'dead'", (job_id,)
+    )
+
+
+def cancel_jobs(
+    state: str,
+    since: str | None = None,
+    command_like: str | None = None,
+    chunk_size: int = BULK_CHUNK_SIZE,
+    on_progress: Callable[[int], None] | None = None,
+) -> int:
+    where, params = _job_filter(state, since, command_like)
+    return _run_chunked(
+        "UPDATE jobs SET state = 'cancelled', updated_at = ?, next_run_time = NULL",
+        lambda: [datetime.now(timezone.utc).isoformat()],
+        where,
+        params,
+        chunk_size,
+        on_progress,
+    )
+
+
+def cancel_job(job_id: str) -> bool:
+    """
+    Cancel a pending or failed job. A map parent never runs itself, so its
+    pending and failed chunks are cancelled instead and jobs_map_rollup
+    cancels the parent once its running chunks end.
+    """
+    return _update_one_job(
+        """
+        UPDATE jobs
+        SET state = 'cancelled', updated_at = ?, next_run_time = NULL
+        WHERE (id = ? OR parent_id = ?) AND state IN ('pending', 'failed')
+        """,
+        (datetime.now(timezone.utc).isoformat(), job_id, job_id),
+    )
@@ -0,0 +1,88 @@
+import typer
+from rich.console import Console
+from rich.table import Table
+import subprocess
+import statistics
+import tempfile
+import time
+import os
+import sys
+
+app = typer.Typer()
+console = Console()
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+MAIN = os.path.join(PROJECT_ROOT, "launcher.py")
+
+
+def time_cli(args: list, env: dict, runs: int) -> list[float]:
+    """wall time in milliseconds of each `queuectl <args>` invocation."""
+    samples = []
+
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, MAIN] + args, env=env, capture_output=True, check=True
+        )
+        samples.append((time.perf_counter() - start) * 1000)
+
+    return samples
+
+
+def time_python(code: str, env: dict, runs: int) -> list[float]:
+    """wall time in milliseconds of each `python -c <code>` from the project root."""
+    samples = []
+
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "-c", code],
+            env=env,
+            cwd=PROJECT_ROOT,
+            check=True,
+        )
+        samples.append((time.perf_counter() - start) * 1000)
+
+    return samples
+
+
+@app.command()
+def run(runs: int = typer.Option(20, "--runs", "-n", help="Invocations per case.")):
+    """
+    Measure CLI startup cost against a throwaway HOME, so the real queue is untouched.
+    """
+    with tempfile.TemporaryDirectory() as home:
+        env = dict(os.environ, HOME=home)
+
+        # first call creates the schema, it is not part of the hot path
+        subprocess.run([sys.executable, MAIN, "status"], env=env, capture_output=True)
+
+        batch = "[" + ",".join(['{"command": "true"}'] * 100) + "]"
+        cases = {
+            "python -c pass": time_python("pass", env, runs),
+            "import main": time_python("import main", env, runs),
+            "import launcher": time_python("import launcher", env, runs),
+            "enqueue": time_cli(["enqueue", '{"command": "true"}'], env, runs),
+            "enqueue (100 job batch)": time_cli(["enqueue", batch], env, runs),
+            "status": time_cli(["status"], env, runs),
+        }
+
+    table = Table(title=f"CLI Startup ({runs} runs each)")
+    table.add_column("Case", style="cyan")
+    table.add_column("Median (ms)", style="magenta", justify="right")
+    table.add_column("Min (ms)", style="green", justify="right")
+    table.add_column("Max (ms)", style="blue", justify="right")
+
+    for name, samples in cases.items():
+        table.add_row(
+            name,
+            f"{statistics.median(samples):.1f}",
+            f"{min(samples):.1f}",
+            f"{max(samples):.1f}",
+        )
+
+    console.print(table)
+
+
+if __name__ == "__main__":
+    app()
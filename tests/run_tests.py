@@ -7,6 +7,8 @@ import sqlite3
 import time
 import os
 import shutil
+import glob
+import json
 import sys
 
 app = typer.Typer()
@@ -51,17 +53,36 @@ def run_cli(command: list, check=True):
     return result
 
 
+def count_matching(state: str, pattern: str) -> int:
+    count = 0
+
+    for db_file in glob.glob(os.path.join(APP_DIR, "queue*.db")):
+        conn = sqlite3.connect(db_file)
+        count += conn.execute(
+            "SELECT COUNT(*) FROM jobs WHERE state = ? AND command LIKE ?",
+            (state, pattern),
+        ).fetchone()[0]
+        conn.close()
+
+    return count
+
+
 def get_db_count(state: str) -> int:
     if not os.path.exists(DB_FILE):
         return 0  # DB not created yet
-    
-    conn = sqlite3.connect(DB_FILE)
 
-    count = conn.execute(
-        "SELECT COUNT(*) FROM jobs WHERE state = ?", (state,)
-    ).fetchone()[0]
+    count = 0
+
+    # queue.db plus queue-<n>.db for every extra shard
+    for db_file in glob.glob(os.path.join(APP_DIR, "queue*.db")):
+        conn = sqlite3.connect(db_file)
+
+        count += conn.execute(
+            "SELECT COUNT(*) FROM jobs WHERE state = ?", (state,)
+        ).fetchone()[0]
+
+        conn.close()
 
-    conn.close()
     return count
 
 
@@ -124,6 +145,19 @@ def test_1_success():
     assert_file_exists(output_file)
     run_cli(["worker", "stop"])
 
+    # measured on the job, not on the shell forked from the worker, so it is
+    # well below the worker's own RSS
+    conn = sqlite3.connect(DB_FILE)
+    maxrss = conn.execute(
+        "SELECT run_maxrss FROM jobs WHERE state = 'completed'"
+    ).fetchone()[0]
+    conn.close()
+
+    if maxrss is None or maxrss > 10 * 1024:
+        fail(f"Expected the echo job to record a small max RSS, found {maxrss}KB")
+
+    success(f"Recorded the job's own max RSS ({maxrss}KB).")
+
 
 def test_2_fail_dlq():
     """Tests a failed job retrying and moving to the DLQ."""
@@ -210,7 +244,554 @@ def test_5_invalid_commands():
 
     success("'invalid state' failed as expected.")
 
+    for value in ("0", "abc"):
+        result = run_cli(["config", "set", "job_timeout", value], check=False)
+        if result.returncode == 0:
+            fail(f"'config set job_timeout {value}' did not return an error")
+
+    success("Invalid job_timeout values were refused.")
+
+
+def process_alive(pid: int) -> bool:
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().split(")")[-1].split()[0] != "Z"
+
+    except FileNotFoundError:
+        return False
+
+
+def test_6_timeout_kills_group():
+    """Tests that a timed out job has its whole process group killed."""
+    console.rule("[bold]Test 6: Timeout Kills Process Group[/bold]", style="cyan")
+    pid_file = os.path.join(TEST_OUTPUT_DIR, "grandchild.pid")
+    run_cli(
+        [
+            "enqueue",
+            f'{{"command": "sleep 30 & echo $! > {pid_file}; wait", "timeout": 1}}',
+        ]
+    )
+    run_cli(["worker", "start", "--count", "1"])
+    info("Waiting for job to time out (3s)...")
+    time.sleep(3)
+    run_cli(["worker", "stop"])
+
+    assert_db_state("failed", 1)
+    assert_file_exists("grandchild.pid")
+
+    with open(pid_file) as f:
+        grandchild = int(f.read().strip())
+
+    if process_alive(grandchild):
+        fail(f"Grandchild process {grandchild} survived the job timeout")
+
+    success("Grandchild process was killed with the job.")
+
+    conn = sqlite3.connect(DB_FILE)
+    exit_code = conn.execute(
+        "SELECT exit_code FROM jobs WHERE state = 'failed'"
+    ).fetchone()[0]
+    conn.close()
+
+    if exit_code is None or exit_code >= 0:
+        fail(f"Expected a signal exit code for the timed out job, found {exit_code}")
+
+    success(f"Recorded exit code {exit_code} for the timed out job.")
+
+
+def test_7_bulk_operations():
+    """Tests filtered bulk DLQ retry, cancel and purge."""
+    console.rule("[bold]Test 7: Bulk DLQ Operations[/bold]", style="cyan")
+
+    for i in range(3):
+        run_cli(["enqueue", f'{{"command": "echo bulk-{i}"}}'])
+    run_cli(["enqueue", '{"command": "echo keep"}'])
+
+    conn = sqlite3.connect(DB_FILE)
+    conn.execute("UPDATE jobs SET state = 'dead' WHERE state = 'pending'")
+    conn.commit()
+    conn.close()
+
+    res = run_cli(["dlq", "retry"], check=False)
+    if res.returncode == 0:
+        fail("'dlq retry' without a job ID or filter did not return an error")
+    success("'dlq retry' without a target failed as expected.")
+
+    for command in (["cancel"], ["dlq", "retry"], ["dlq", "purge"]):
+        if run_cli(command + ["no-such-job"], check=False).returncode != 1:
+            fail(f"'{' '.join(command)}' of an unknown job ID did not exit 1")
+    success("Unknown job IDs exit 1 for cancel, dlq retry and dlq purge.")
+
+    run_cli(["dlq", "retry", "--since", "1h", "--command-like", "echo bulk-%"])
+    assert_db_state("pending", 3)
+
+    run_cli(["cancel", "--state", "pending", "--filter", "echo bulk-%"])
+    assert_db_state("cancelled", 3)
+
+    run_cli(["dlq", "purge", "--all"])
+    assert_db_state("dead", 0)
+
+
+def test_8_sharding():
+    """Tests jobs spread across shards and a single worker draining all of them."""
+    console.rule("[bold]Test 8: Sharded Storage[/bold]", style="cyan")
+    completed_before = get_db_count("completed")
+
+    run_cli(["config", "set", "shards", "2"])
+    for i in range(10):
+        run_cli(["enqueue", f'{{"command": "echo shard-{i}"}}'])
+
+    if not os.path.exists(os.path.join(APP_DIR, "queue-1.db")):
+        fail("Shard file queue-1.db was not created")
+    success("Shard file queue-1.db created.")
+
+    assert_db_state("pending", 10)
+
+    res = run_cli(["config", "set", "shards", "1"], check=False)
+    if res.returncode == 0:
+        fail("Shrinking shards with jobs in a dropped shard did not return an error")
+    success("Shrinking shards with pending jobs failed as expected.")
+
+    run_cli(["worker", "start", "--count", "1"])
+    info("Waiting for one worker to drain both shards (3s)...")
+    time.sleep(3)
+
+    assert_db_state("completed", completed_before + 10)
+    run_cli(["worker", "stop"])
+
+
+def test_9_daemon():
+    """Tests enqueue and status through the Unix socket daemon."""
+    console.rule("[bold]Test 9: Local Daemon[/bold]", style="cyan")
+    from client import QueueClient
+
+    socket_path = os.path.join(APP_DIR, "queuectl.sock")
+    daemon = subprocess.Popen(
+        ["queuectl", "serve"], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+    )
+
+    try:
+        for _ in range(50):
+            if os.path.exists(socket_path):
+                break
+            time.sleep(0.1)
+
+        else:
+            fail("Daemon did not create its socket", stderr=daemon.stderr.read())
+
+        with QueueClient(socket_path) as client:
+            client.enqueue("echo daemon-single")
+            ids = client.enqueue_batch(
+                [{"command": f"echo daemon-{i}"} for i in range(4)]
+            )
+
+            if len(ids) != 4:
+                fail(f"Batch enqueue returned {len(ids)} IDs, expected 4")
+
+            pending = client.status()["pending"]
+            oldest = client.list_jobs("pending", limit=2)
+
+        if pending != 5:
+            fail(f"Daemon status reported {pending} pending jobs, expected 5")
+        success("Daemon enqueued 5 jobs and reported them in status.")
+
+        commands = [job["command"] for job in oldest]
+        if commands != ["echo daemon-single", "echo daemon-0"]:
+            fail(f"Expected the 2 oldest pending jobs from 'list', found {commands}")
+        success("Daemon listed the oldest jobs up to the limit.")
+
+        assert_db_state("pending", 5)
+
+    finally:
+        daemon.terminate()
+        daemon.wait(timeout=5)
+
+    if os.path.exists(socket_path):
+        fail("Daemon did not remove its socket on shutdown")
+    success("Daemon shut down and removed its socket.")
+
+
+def test_10_admission():
+    """Tests that workers only claim jobs that fit the host capacity."""
+    console.rule("[bold]Test 10: Resource-Aware Admission[/bold]", style="cyan")
+    run_cli(["config", "set", "host_cpus", "2"])
+    run_cli(
+        [
+            "enqueue",
+            '[{"command": "sleep 2 # admit-a", "cpus": 1},'
+            ' {"command": "sleep 2 # admit-b", "cpus": 1},'
+            ' {"command": "sleep 2 # admit-c", "cpus": 1}]',
+        ]
+    )
+
+    try:
+        run_cli(["worker", "start", "--count", "3"])
+        info("Waiting for workers to claim what fits (1s)...")
+        time.sleep(1)
+
+        running = count_matching("processing", "%# admit-%")
+        run_cli(["worker", "stop"])
+
+    finally:
+        run_cli(["config", "set", "host_cpus", "0"])  # detect again
+
+    if running != 2:
+        fail(f"Expected 2 admitted jobs on a 2 cpu host, found {running} processing")
+    success("Only 2 of 3 one-cpu jobs were admitted on a 2 cpu host.")
+
+
+def test_11_payloads():
+    """Tests that env, stdin, cwd and a long command reach the job and output is stored."""
+    console.rule("[bold]Test 11: Out-of-Row Payloads[/bold]", style="cyan")
+    run_cli(["cancel", "--all"])  # leftovers of earlier tests would delay the job
+    padding = ": " + "x" * 600 + "; "
+    job = json.dumps(
+        {
+            "command": padding + 'printf "%s|%s|%s" "$QC_TEST" "$(cat)" "$(pwd)"',
+            "env": {"QC_TEST": "from-env"},
+            "stdin": "from-stdin",
+            "cwd": TEST_OUTPUT_DIR,
+        }
+    )
+    result = run_cli(["enqueue", job])
+    job_id = result.stdout.strip().rsplit(" ", 1)[-1]
+
+    run_cli(["worker", "start", "--count", "1"])
+    info("Waiting for job to complete (2s)...")
+    time.sleep(2)
+    run_cli(["worker", "stop"])
+
+    result = run_cli(["output", job_id])
+    expected = f"from-env|from-stdin|{TEST_OUTPUT_DIR}"
+
+    if result.stdout != expected:
+        fail(f"Expected output '{expected}', got '{result.stdout}'")
+    success("Payload reached the job and its output was stored.")
+
+
+def test_12_map_jobs():
+    """Tests a map job rolls up to its parent and a retry only reruns the failed input."""
+    console.rule("[bold]Test 12: Map Jobs[/bold]", style="cyan")
+    run_cli(["config", "set", "max_retries", "1"])
+    job = json.dumps(
+        {
+            "command": "echo {} >> runs.log; test {} -ne 3 || test -e fixed",
+            "map": [str(i) for i in range(10)],
+            "chunk_size": 4,
+            "cwd": TEST_OUTPUT_DIR,
+        }
+    )
+    result = run_cli(["enqueue", job])
+    parent_id = result.stdout.strip().rsplit(" ", 1)[-1]
+
+    run_cli(["worker", "start", "--count", "2"])
+    info("Waiting for the 3 chunks to run (2s)...")
+    time.sleep(2)
+    run_cli(["worker", "stop"])
+
+    result = run_cli(["items", parent_id])
+    if "(dead)" not in result.stdout:
+        fail("Expected the map job to be dead after input 3 failed", result.stdout)
+    success("Failed input rolled up to a dead parent.")
+
+    chunk_ids = []
+    for db_file in glob.glob(os.path.join(APP_DIR, "queue*.db")):
+        conn = sqlite3.connect(db_file)
+        chunk_ids += conn.execute(
+            "SELECT id FROM jobs WHERE parent_id = ? AND state = 'dead'", (parent_id,)
+        ).fetchall()
+        conn.close()
+    chunk_id = chunk_ids[0][0]
+
+    if run_cli(["dlq", "purge", chunk_id], check=False).returncode == 0:
+        fail("Expected purging a single map chunk to be refused")
+    success("Purging a single chunk was refused.")
+
+    open(os.path.join(TEST_OUTPUT_DIR, "fixed"), "w").close()
+    run_cli(["dlq", "retry", parent_id])
+    run_cli(["worker", "start", "--count", "1"])
+    info("Waiting for the retried chunk (2s)...")
+    time.sleep(2)
+    run_cli(["worker", "stop"])
+    run_cli(["config", "set", "max_retries", "3"])
+
+    result = run_cli(["items", parent_id])
+    if "(completed)" not in result.stdout:
+        fail("Expected the map job to complete after the retry", result.stdout)
+
+    with open(os.path.join(TEST_OUTPUT_DIR, "runs.log")) as f:
+        runs = len(f.readlines())
+
+    if runs != 11:
+        fail(f"Expected 11 input runs (10 + 1 retried), found {runs}")
+    success("Retry reran only the failed input and the parent completed.")
+
+
+def test_18_cancel_map_job():
+    """Tests cancelling a map job by its parent ID cancels its chunks and the parent."""
+    console.rule("[bold]Test 18: Cancel Map Job[/bold]", style="cyan")
+    job = json.dumps({"command": "echo {}", "map": ["1", "2", "3"], "chunk_size": 1})
+    result = run_cli(["enqueue", job])
+    parent_id = result.stdout.strip().rsplit(" ", 1)[-1]
+
+    if run_cli(["cancel", parent_id], check=False).returncode != 0:
+        fail("Expected cancelling the map job by its parent ID to succeed")
+
+    states = []
+    for db_file in glob.glob(os.path.join(APP_DIR, "queue*.db")):
+        conn = sqlite3.connect(db_file)
+        states += conn.execute(
+            "SELECT state FROM jobs WHERE id = ? OR parent_id = ?",
+            (parent_id, parent_id),
+        ).fetchall()
+        conn.close()
+
+    if states != [("cancelled",)] * 4:
+        fail(f"Expected the parent and its 3 chunks cancelled, found {states}")
+    success("Cancelling the parent cancelled its chunks and rolled up.")
+
+
+def test_13_result_cache():
+    """Tests an identical cacheable job completes from the cache without running."""
+    console.rule("[bold]Test 13: Result Cache[/bold]", style="cyan")
+    runs_file = os.path.join(TEST_OUTPUT_DIR, "cache_runs.log")
+    job = json.dumps({"command": f"echo run >> {runs_file}; echo cached", "cache_ttl": 60})
+    run_cli(["enqueue", job])
+
+    run_cli(["worker", "start", "--count", "1"])
+    info("Waiting for the first run (2s)...")
+    time.sleep(2)
+    run_cli(["worker", "stop"])
+
+    result = run_cli(["enqueue", job])
+    job_id = result.stdout.strip().rsplit(" ", 1)[-1]
+
+    if run_cli(["output", job_id]).stdout != "cached\n":
+        fail("Expected the second job to complete with the cached output")
+
+    with open(runs_file) as f:
+        runs = len(f.readlines())
+
+    if runs != 1:
+        fail(f"Expected the command to run once, it ran {runs} times")
+
+    stats = run_cli(["cache", "stats"]).stdout
+    if "50.0%" not in stats:
+        fail("Expected one hit and one miss in the cache stats", stats)
+    success("Second job was served from the cache without running.")
+
+
+def test_14_broker():
+    """Tests remote workers claiming, acking and nacking through the TCP broker."""
+    console.rule("[bold]Test 14: TCP Broker[/bold]", style="cyan")
+    from client import BrokerClient, QueueClientError
+
+    run_cli(["cancel", "--all"])  # leftovers of earlier tests would delay the jobs
+    run_cli(["config", "set", "max_retries", "1"])
+    address = ("127.0.0.1", 7651)
+    broker = subprocess.Popen(
+        ["queuectl", "broker", "--port", str(address[1])],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+
+    try:
+        client = BrokerClient(address, timeout=5)
+
+        for _ in range(50):
+            try:
+                client.ping()
+                break
+
+            except (OSError, QueueClientError):
+                time.sleep(0.1)
+
+        else:
+            fail("Broker did not start listening", stderr=broker.stderr.read())
+
+        client.enqueue_batch(
+            [{"command": f"echo broker-{i}"} for i in range(4)]
+            + [{"command": "exit 1 # broker-fail"}]
+        )
+        client.close()
+
+        run_cli(["worker", "start", "--count", "2", "--broker", "127.0.0.1:7651"])
+        info("Waiting for remote workers (2s)...")
+        time.sleep(2)
+        run_cli(["worker", "stop"])
+
+    finally:
+        broker.terminate()
+        broker.wait(timeout=5)
+        run_cli(["config", "set", "max_retries", "3"])
+
+    completed = count_matching("completed", "echo broker-%")
+    if completed != 4:
+        fail(f"Expected 4 jobs completed through the broker, found {completed}")
+
+    if count_matching("dead", "%# broker-fail") != 1:
+        fail("Expected the failing job in the DLQ after its only attempt")
+
+    if count_matching("processing", "%") != 0:
+        fail("Broker left leased jobs in processing after shutdown")
+    success("Remote workers completed 4 jobs and the failing one went to the DLQ.")
+
+
+def test_15_history():
+    """Tests every transition of a job is recorded and feeds the latency report."""
+    console.rule("[bold]Test 15: Job History[/bold]", style="cyan")
+    run_cli(["cancel", "--all"])  # leftovers of earlier tests would delay the job
+    run_cli(["config", "set", "max_retries", "1"])
+    result = run_cli(["enqueue", json.dumps({"command": "exit 2"})])
+    job_id = result.stdout.strip().rsplit(" ", 1)[-1]
+
+    run_cli(["worker", "start", "--count", "1"])
+    info("Waiting for the job to fail (2s)...")
+    time.sleep(2)
+    run_cli(["worker", "stop"])
+    run_cli(["config", "set", "max_retries", "3"])
+
+    transitions = []
+    for db_file in glob.glob(os.path.join(APP_DIR, "queue*.db")):
+        conn = sqlite3.connect(db_file)
+        transitions += conn.execute(
+            "SELECT prev_state, state, exit_code FROM job_events "
+            "WHERE job_id = ? ORDER BY id",
+            (job_id,),
+        ).fetchall()
+        conn.close()
+
+    expected = [
+        (None, "pending", None),
+        ("pending", "processing", None),
+        ("processing", "dead", 2),
+    ]
+    if transitions != expected:
+        fail(f"Expected enqueue, claim and death events, found {transitions}")
+
+    if "dead" not in run_cli(["history", job_id]).stdout:
+        fail("Expected the history command to show the job's death")
+
+    report = run_cli(["latency", "--since", "1h"]).stdout
+    if "Run" not in report or "Wait" not in report:
+        fail("Expected wait and run rows in the latency report", report)
+    success("Enqueue, claim and failure were recorded and reported.")
+
+    run_cli(["prune-history", "--before", "1h"])
+    if run_cli(["history", job_id], check=False).returncode != 0:
+        fail("Expected pruning older history to keep the job's events")
+
+    pruned = run_cli(["prune-history", "--before", "2999-01-01T00:00:00"]).stdout
+    history = run_cli(["history", job_id], check=False)
+    if "Deleted" not in pruned or history.returncode != 1:
+        fail("Expected prune-history to delete the job's events", pruned)
+    success("prune-history kept recent events and deleted older ones.")
+
+
+def assert_state_counts(step: str):
+    """the trigger-maintained state_counts of every shard match a GROUP BY."""
+    for db_file in glob.glob(os.path.join(APP_DIR, "queue*.db")):
+        conn = sqlite3.connect(db_file)
+        counted = dict(
+            conn.execute("SELECT state, count FROM state_counts WHERE count != 0")
+        )
+        grouped = dict(conn.execute("SELECT state, count(*) FROM jobs GROUP BY state"))
+        conn.close()
+
+        if counted != grouped:
+            fail(f"state_counts drifted after {step}: {counted} != {grouped}")
+
+    success(f"state_counts match the jobs table after {step}.")
+
+
+def test_16_state_counts():
+    """Tests the state_counts triggers stay exact and the top dashboard renders."""
+    console.rule("[bold]Test 16: State Counts and Dashboard[/bold]", style="cyan")
+    import io
+    import db
+    from dashboard import Dashboard
+
+    run_cli(["config", "set", "max_retries", "1"])
+    run_cli(
+        [
+            "enqueue",
+            json.dumps(
+                [{"command": f"echo counts-{i}"} for i in range(3)]
+                + [{"command": "exit 1 # counts-fail"}]
+                + [{"command": "echo {}", "map": ["a", "b", "c"], "chunk_size": 1}]
+            ),
+        ]
+    )
+    assert_state_counts("enqueue")
+
+    run_cli(["worker", "start", "--count", "2"])
+    info("Waiting for the jobs and map chunks to run (2s)...")
+    time.sleep(2)
+    run_cli(["worker", "stop"])
+    run_cli(["config", "set", "max_retries", "3"])
+    assert_state_counts("claims, completions and the map rollup")
+
+    run_cli(["enqueue", json.dumps([{"command": "echo counts-cancel"}] * 2)])
+    run_cli(["cancel", "--all"])
+    assert_state_counts("a bulk cancel")
+
+    run_cli(["dlq", "purge", "--all"])
+    assert_state_counts("a bulk purge")
+
+    board = Dashboard()
+    board.refresh()
+    output = io.StringIO()
+    Console(file=output, width=120).print(board.render())
+    db.close_conn()
+
+    grouped = {}
+    for db_file in glob.glob(os.path.join(APP_DIR, "queue*.db")):
+        conn = sqlite3.connect(db_file)
+        rows = conn.execute("SELECT state, count(*) FROM jobs GROUP BY state")
+        for state, count in rows:
+            grouped[state] = grouped.get(state, 0) + count
+        conn.close()
+
+    if {state: n for state, n in board.counts.items() if n} != grouped:
+        fail(f"Dashboard counts {board.counts} do not match the jobs table {grouped}")
+
+    rendered = output.getvalue()
+    if "Job States" not in rendered or "Recent Failures" not in rendered:
+        fail("Dashboard render is missing its tables", rendered)
+    success("Dashboard refreshed and rendered the current counts.")
+
+
+def test_17_profiling():
+    """Tests a profiled worker dumps its profile and phases for 'profile report'."""
+    console.rule("[bold]Test 17: Worker Profiling[/bold]", style="cyan")
+    profile_dir = "/tmp/queuectl_profiles"
+
+    run_cli(["profile", "clear"])
+    run_cli(["enqueue", '{"command": "echo profiled"}'])
+    run_cli(["worker", "start", "--count", "1", "--profile"])
+    info("Waiting for the profiled worker to run the job (2s)...")
+    time.sleep(2)
+    run_cli(["worker", "stop"])
+
+    # the worker writes its dumps on exit, after its current sleep second
+    for _ in range(50):
+        profiles = glob.glob(os.path.join(profile_dir, "*.prof"))
+        phase_files = glob.glob(os.path.join(profile_dir, "*.phases.json"))
+
+        if profiles and phase_files:
+            break
+        time.sleep(0.1)
+
+    else:
+        fail(f"Expected a .prof and a .phases.json file in {profile_dir}")
+    success("Profiled worker wrote its .prof and .phases.json files.")
+
+    report = run_cli(["profile", "report", "--limit", "5"]).stdout
+    if "claim" not in report or "run" not in report:
+        fail("Expected the claim and run phases in the profile report", report)
+    success("'profile report' listed the claim and run phases.")
 
+    run_cli(["profile", "clear"])
 
 
 @app.command()
@@ -227,6 +808,19 @@ def run():
         test_3_concurrency()
         test_4_persistence()
         test_5_invalid_commands()
+        test_6_timeout_kills_group()
+        test_7_bulk_operations()
+        test_8_sharding()
+        test_9_daemon()
+        test_10_admission()
+        test_11_payloads()
+        test_12_map_jobs()
+        test_13_result_cache()
+        test_14_broker()
+        test_15_history()
+        test_16_state_counts()
+        test_17_profiling()
+        test_18_cancel_map_job()
 
     except Exception as e:
         fail(f"A critical test error occurred: {e}")
@@ -1,15 +1,36 @@
+import ctypes
+import functools
+import shlex
+import socket
 import subprocess
+import tempfile
+import threading
 import time
 import signal
+from collections import deque
+from dataclasses import asdict, replace
 from datetime import datetime, timedelta, timezone
 import queue_ctl
 import model
+from client import BrokerClient, QueueClientError
 from db import close_conn, load_config
+from profiling import phases, timed
 import os
 
 LOG_DIR = "/tmp/queuectl_logs"
+DEFAULT_JOB_TIMEOUT = 60
 
+# jobs a remote worker leases per claim round trip
+DEFAULT_PREFETCH = 4
 
+# seconds between lease renewals, well below the broker's lease timeout
+HEARTBEAT_INTERVAL = 5.0
+
+# prctl option from <linux/prctl.h>
+PR_SET_CHILD_SUBREAPER = 36
+
+
+@timed("log")
 def log(worker_id: str, message: str):
     try:
         os.makedirs(LOG_DIR, exist_ok=True)
@@ -24,21 +45,566 @@ def log(worker_id: str, message: str):
         pass
 
 
+def _limit_resources(job: model.Job, command: str) -> str:
+    """
+    Prefix the command with the shell builtins applying the job's rlimits and
+    nice value. A preexec_fn would do it in the forked child, which is not
+    safe once the worker runs threads (the remote heartbeat). The command
+    itself runs in a fresh shell so `$$` is the process the worker waits on.
+    """
+    lines = []
+
+    if job.cpu_seconds:
+        # soft limit delivers SIGXCPU, the hard limit one second later SIGKILL
+        lines.append(
+            f"ulimit -S -t {job.cpu_seconds} && ulimit -H -t {job.cpu_seconds + 1}"
+            " || exit 125"
+        )
+
+    if job.max_rss:
+        # RLIMIT_RSS is not enforced by Linux, cap the address space instead
+        lines.append(f"ulimit -v {job.max_rss * 1024} || exit 125")
+
+    nice = f"nice -n {job.nice} " if job.nice else ""
+    lines.append(f"exec {nice}/bin/sh -c {shlex.quote(command)}")
+
+    return "\n".join(lines)
+
+
+def _spawn_script(job: model.Job, command: str, pid_path: str) -> str:
+    """
+    Shell script starting the job in the background, writing its pid to
+    `pid_path` and exiting. The job is then reparented to the worker, which
+    waits on it directly: the shell was forked from the worker and its max
+    RSS starts at the worker's own, the job forked from the shell does not.
+    """
+    return (
+        # background commands get /dev/null as stdin unless redirected
+        "exec 4<&0\n"
+        f"{{\n{_limit_resources(job, command)}\n}} <&4 4<&- &\n"
+        f"echo $! >{shlex.quote(pid_path)}\n"
+    )
+
+
+@functools.cache
+def _adopt_orphans():
+    """make the worker the parent of orphaned descendants, not init."""
+    libc = ctypes.CDLL(None, use_errno=True)
+
+    if libc.prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+
+def _reap_orphans():
+    """reap leftovers of earlier jobs that have exited since."""
+    try:
+        while os.waitpid(-1, os.WNOHANG)[0]:
+            pass
+
+    except ChildProcessError:
+        pass
+
+
+def _kill_group(pgid: int):
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+
+    except ProcessLookupError:
+        pass
+
+
+def run_job_command(
+    job: model.Job,
+    default_timeout: int = DEFAULT_JOB_TIMEOUT,
+    payload: model.JobPayload | None = None,
+) -> tuple[model.RunUsage, str, str]:
+    """
+    Run the job command in its own session and wait for it with a deadline.
+
+    On timeout the whole process group is killed, not only the shell, so
+    grandchildren do not outlive the job. Output goes to temp files rather
+    than pipes so a chatty job cannot block on a full pipe while we wait.
+    """
+    timeout = job.timeout or default_timeout
+    payload = payload or model.JobPayload()
+    env = {**os.environ, **payload.env} if payload.env else None
+
+    with (
+        tempfile.TemporaryFile() as out,
+        tempfile.TemporaryFile() as err,
+        tempfile.NamedTemporaryFile("r", prefix="queuectl-pid-") as pid_file,
+    ):
+        stdin = subprocess.DEVNULL
+
+        if payload.stdin is not None:
+            stdin = tempfile.TemporaryFile()
+            stdin.write(payload.stdin.encode())
+            stdin.seek(0)
+
+        started = time.monotonic()
+
+        try:
+            with phases.phase("spawn"):
+                _adopt_orphans()
+                proc = subprocess.Popen(
+                    _spawn_script(job, payload.command or job.command, pid_file.name),
+                    shell=True,
+                    stdin=stdin,
+                    stdout=out,
+                    stderr=err,
+                    cwd=payload.cwd,
+                    env=env,
+                    start_new_session=True,
+                )
+
+                # the shell exits as soon as the job is started
+                _, status, _ = os.wait4(proc.pid, 0)
+                proc.returncode = os.waitstatus_to_exitcode(status)
+                job_pid = int(pid_file.read())
+
+        finally:
+            if stdin is not subprocess.DEVNULL:
+                stdin.close()
+
+        spawned = time.monotonic()
+        deadline = started + timeout
+        timed_out = False
+        delay = 0.001
+
+        while True:
+            pid, status, rusage = os.wait4(job_pid, os.WNOHANG)
+
+            if pid:
+                break
+
+            if time.monotonic() >= deadline:
+                timed_out = True
+                _kill_group(proc.pid)
+                pid, status, rusage = os.wait4(job_pid, 0)
+                break
+
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+
+        phases.add("run", time.monotonic() - spawned)
+
+        if timed_out:
+            # the job is gone, sweep anything it left behind in the group
+            _kill_group(proc.pid)
+
+        _reap_orphans()
+
+        usage = model.RunUsage(
+            exit_code=os.waitstatus_to_exitcode(status),
+            utime=rusage.ru_utime,
+            stime=rusage.ru_stime,
+            maxrss=rusage.ru_maxrss,
+            wall_time=time.monotonic() - started,
+            timed_out=timed_out,
+        )
+
+        out.seek(0)
+        err.seek(0)
+        stdout = out.read().decode(errors="replace")
+        stderr = err.read().decode(errors="replace")
+
+    return usage, stdout, stderr
+
+
+def build_map_script(
+    template: str, items: list[tuple[int, str]], timeout: int | None = None
+) -> str:
+    """
+    One shell script running the template once per input, each in a subshell
+    so an `exit` only ends its own input. `{}` is replaced by the quoted
+    input, without it the input is appended as the last argument. Every exit
+    code is written as "<idx> <code>" to fd 3, which the inputs do not see.
+
+    With a timeout each input runs under coreutils `timeout`, which kills
+    the input's process group and exits 124 (137 when it had to SIGKILL).
+    """
+    lines = ['exec 3>>"$QC_MAP_STATUS"']
+
+    for idx, value in items:
+        quoted = shlex.quote(value)
+        command = (
+            template.replace("{}", quoted) if "{}" in template else f"{template} {quoted}"
+        )
+
+        if timeout:
+            lines.append(
+                f"timeout -k 1 {timeout} sh -c {shlex.quote(command)} </dev/null 3>&-"
+            )
+
+        else:
+            lines.append(f"( {command}\n) </dev/null 3>&-")
+
+        lines.append(f'echo "{idx} $?" >&3')
+
+    return "\n".join(lines) + "\n"
+
+
+def run_map_chunk(
+    job: model.Job,
+    default_timeout: int = DEFAULT_JOB_TIMEOUT,
+    payload: model.JobPayload | None = None,
+    items: list[tuple[int, str]] = (),
+) -> tuple[model.RunUsage, str, str, dict[int, int]]:
+    """
+    Run the not yet succeeded inputs of a map chunk through a single shell
+    fed the script on stdin, instead of one claim and one spawn per input.
+
+    The job's timeout limits each input, not the chunk. The chunk as a
+    whole only gets a backstop deadline of every input running to its
+    limit. The chunk's exit code is the first failing input's, inputs the
+    backstop cut off are left out of the results and count as failed.
+    """
+    payload = payload or model.JobPayload()
+    timeout = job.timeout or default_timeout
+
+    with tempfile.NamedTemporaryFile("r", prefix="queuectl-map-") as status:
+        usage, stdout, stderr = run_job_command(
+            # one second of SIGKILL grace per input on top of its timeout
+            replace(job, timeout=(timeout + 1) * max(len(items), 1) + 1),
+            default_timeout,
+            model.JobPayload(
+                command="sh -s",
+                env={**(payload.env or {}), "QC_MAP_STATUS": status.name},
+                stdin=build_map_script(payload.command or job.command, items, timeout),
+                cwd=payload.cwd,
+            ),
+        )
+
+        results = {}
+        for line in status:
+            idx, code = line.split()
+            results[int(idx)] = int(code)
+
+    if not usage.timed_out:
+        failed = [results.get(idx, usage.exit_code or 1) for idx, _ in items]
+        usage.exit_code = next((code for code in failed if code != 0), 0)
+
+    return usage, stdout, stderr, results
+
+
+def detect_capacity(config: dict) -> model.HostCapacity:
+    """host capacity from config, 0 or missing values are detected from the machine."""
+    cpus = config.get("host_cpus") or os.cpu_count() or 1
+    memory_mb = config.get("host_memory_mb") or (
+        os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // (1024 * 1024)
+    )
+    return model.HostCapacity(cpus=cpus, memory_mb=memory_mb)
+
+
+class LocalQueue:
+    """the worker's view of the queue when it runs on the host of the database."""
+
+    def __init__(self, worker_id: str, home_shard: int, config: dict):
+        self.worker_id = worker_id
+
+        # shard claimed from first, others are only used for work stealing
+        self.home_shard = home_shard
+        self.config = config
+
+    def claim(self, capacity: model.HostCapacity) -> model.Job | None:
+        return queue_ctl.fetch_job_atomically(self.home_shard, self.worker_id, capacity)
+
+    def complete_from_cache(self, job: model.Job) -> bool:
+        return job.cache_key is not None and queue_ctl.complete_from_cache(job)
+
+    def load_payload(self, job: model.Job) -> model.JobPayload | None:
+        return queue_ctl.load_payload(job)
+
+    def load_map_items(self, job: model.Job) -> list[tuple[int, str]]:
+        return queue_ctl.load_map_items(job)
+
+    def complete(
+        self,
+        job: model.Job,
+        usage: model.RunUsage,
+        output: tuple[str, str],
+        item_results: dict[int, int] | None = None,
+    ):
+        queue_ctl.update_job_state(
+            job.id,
+            "completed",
+            next_run_time=None,
+            usage=usage,
+            shard=job.shard,
+            output=output,
+            item_results=item_results,
+            cache_key=job.cache_key,
+        )
+
+    def fail(
+        self,
+        job: model.Job,
+        usage: model.RunUsage | None = None,
+        output: tuple[str, str] | None = None,
+        item_results: dict[int, int] | None = None,
+    ) -> int | None:
+        return queue_ctl.fail_job(
+            job, self.config["backoff_base"], usage, output, item_results
+        )
+
+    def requeue(self, job: model.Job):
+        queue_ctl.requeue_interrupted_job(job.id, job.attempts, job.shard)
+
+    def close(self):
+        close_conn()
+
+
+class RemoteQueue:
+    """
+    The worker's view of the queue through `queuectl broker`, for hosts
+    without the database.
+
+    One claim leases up to `prefetch` jobs together with their payloads and
+    map inputs. The broker is told each job started before it runs, with
+    the claim for the first one and with the previous job's ack or nack for
+    the others, so a prefetched job costs a single round trip. A background
+    thread renews the leases while they wait or run.
+    """
+
+    def __init__(
+        self,
+        worker_id: str,
+        address: tuple[str, int],
+        prefetch: int = DEFAULT_PREFETCH,
+    ):
+        self.worker_id = worker_id
+        self.address = address
+        self.prefetch = prefetch
+        self.host = socket.gethostname()
+        self.client = BrokerClient(address)
+
+        self.buffer: deque[model.Job] = deque()
+        self.extras: dict[str, tuple[model.JobPayload | None, list | None]] = {}
+        self.running: str | None = None
+
+        # buffered job the broker already marked started
+        self.started: str | None = None
+
+        # leases the broker reclaimed, their results would be rejected
+        self.lost: set[str] = set()
+
+        self.stopped = threading.Event()
+        self.heartbeat = threading.Thread(target=self._renew_leases, daemon=True)
+        self.heartbeat.start()
+
+    def hello(self) -> dict:
+        return self.client.hello(self.worker_id)
+
+    @timed("claim")
+    def claim(self, capacity: model.HostCapacity) -> model.Job | None:
+        if not self.buffer:
+            messages = self.client.claim(
+                self.worker_id, self.host, self.prefetch, asdict(capacity), start=True
+            )
+
+            for message in messages:
+                job = model.Job(**message["job"])
+                payload = message["payload"]
+                items = message["items"]
+                self.extras[job.id] = (
+                    model.JobPayload(**payload) if payload else None,
+                    [tuple(item) for item in items] if items is not None else None,
+                )
+                self.buffer.append(job)
+
+            self.started = self.buffer[0].id if self.buffer else None
+
+        while self.buffer:
+            job = self.buffer.popleft()
+
+            if job.id in self.lost:
+                self._forget(job)
+                continue
+
+            # the broker must know the job started before it runs, a job
+            # that kills this worker then counts as an attempt. The claim or
+            # the last ack/nack has told it, unless that request failed.
+            if job.id != self.started:
+                try:
+                    held = self.client.start(self.worker_id, job.id)
+
+                except (OSError, QueueClientError):
+                    self.buffer.appendleft(job)
+                    raise
+
+                if not held:
+                    self._forget(job)
+                    continue
+
+            self.started = None
+            self.running = job.id
+            return job
+
+        return None
+
+    def complete_from_cache(self, job: model.Job) -> bool:
+        # the broker checks the cache before it leases a job
+        return False
+
+    def load_payload(self, job: model.Job) -> model.JobPayload | None:
+        return self.extras[job.id][0]
+
+    def load_map_items(self, job: model.Job) -> list[tuple[int, str]]:
+        return self.extras[job.id][1] or []
+
+    @timed("update")
+    def complete(
+        self,
+        job: model.Job,
+        usage: model.RunUsage,
+        output: tuple[str, str],
+        item_results: dict[int, int] | None = None,
+    ):
+        next_id = self._next_to_start()
+
+        try:
+            held = self.client.ack(
+                self.worker_id,
+                job.id,
+                start=next_id,
+                usage=asdict(usage),
+                output=list(output),
+                item_results=item_results,
+            )
+            self._mark_started(next_id, held)
+
+        finally:
+            self._forget(job)
+
+    @timed("update")
+    def fail(
+        self,
+        job: model.Job,
+        usage: model.RunUsage | None = None,
+        output: tuple[str, str] | None = None,
+        item_results: dict[int, int] | None = None,
+    ) -> int | None:
+        next_id = self._next_to_start()
+
+        try:
+            delay, held = self.client.nack(
+                self.worker_id,
+                job.id,
+                start=next_id,
+                usage=asdict(usage) if usage is not None else None,
+                output=list(output) if output is not None else None,
+                item_results=item_results,
+            )
+            self._mark_started(next_id, held)
+            return delay
+
+        finally:
+            self._forget(job)
+
+    def requeue(self, job: model.Job):
+        try:
+            self.client.release(self.worker_id, [job.id])
+
+        finally:
+            self._forget(job)
+
+    def close(self):
+        self.stopped.set()
+        self.heartbeat.join()
+
+        # prefetched jobs this worker will not run go back to the queue
+        unrun = [job.id for job in self.buffer if job.id not in self.lost]
+
+        try:
+            if unrun:
+                self.client.release(self.worker_id, unrun)
+
+        except (OSError, QueueClientError):
+            pass  # the broker reclaims them when their leases expire
+
+        self.client.close()
+
+    def _next_to_start(self) -> str | None:
+        """the buffered job claim will return next."""
+        return next((job.id for job in self.buffer if job.id not in self.lost), None)
+
+    def _mark_started(self, job_id: str | None, held: bool | None):
+        if held:
+            self.started = job_id
+
+        elif held is False:
+            self.lost.add(job_id)
+
+    def _forget(self, job: model.Job):
+        self.extras.pop(job.id, None)
+        self.lost.discard(job.id)
+
+        if self.running == job.id:
+            self.running = None
+
+    def _renew_leases(self):
+        while not self.stopped.wait(HEARTBEAT_INTERVAL):
+            held = [job.id for job in list(self.buffer)]
+
+            if self.running is not None:
+                held.append(self.running)
+
+            if not held:
+                continue
+
+            try:
+                lost = self.client.heartbeat(self.worker_id, held, self.running)
+                self.lost.update(lost)
+
+            except (OSError, QueueClientError) as e:
+                log(self.worker_id, f"Heartbeat failed: {e}")
+
+
 class Worker:
-    def __init__(self, worker_id: str):
+    def __init__(
+        self,
+        worker_id: str,
+        home_shard: int = 0,
+        broker: tuple[str, int] | None = None,
+        prefetch: int = DEFAULT_PREFETCH,
+    ):
         self.worker_id = worker_id
 
         try:
-            self.config = load_config()
+            if broker is None:
+                self.config = load_config()
+
+            else:
+                self.queue = RemoteQueue(worker_id, broker, prefetch)
+                self.config = self.queue.hello()
+
         except Exception as e:
             log(worker_id, f"CRITICAL: Failed to load config: {e}")
-            self.config = {"max_retries": 3, "backoff_base": 2}
+            self.config = {
+                "max_retries": 3,
+                "backoff_base": 2,
+                "job_timeout": DEFAULT_JOB_TIMEOUT,
+            }
+
+        if broker is None:
+            self.queue = LocalQueue(worker_id, home_shard, self.config)
+
+        # a remote host's capacity is detected locally, host_cpus and
+        # host_memory_mb describe the broker's host
+        self.capacity = detect_capacity(self.config)
 
         self.shutdown_flag = False
         log(self.worker_id, "Starting...")
+
+        if broker is not None:
+            log(self.worker_id, f"Claiming from broker {broker[0]}:{broker[1]}")
+
         log(
             self.worker_id,
-            f"Config loaded (Max Retries: {self.config['max_retries']}, Backoff: {self.config['backoff_base']})",
+            f"Config loaded (Max Retries: {self.config['max_retries']}, Backoff: {self.config['backoff_base']}, "
+            f"Timeout: {self.config.get('job_timeout', DEFAULT_JOB_TIMEOUT)}, "
+            f"Capacity: {self.capacity.cpus} cpus / {self.capacity.memory_mb} MB)",
         )
 
     def setup_signal_handlers(self):
@@ -58,7 +624,7 @@ class Worker:
         try:
             while not self.shutdown_flag:
                 try:
-                    job = queue_ctl.fetch_job_atomically()
+                    job = self.queue.claim(self.capacity)
 
                     if job:
                         log(
@@ -71,6 +637,10 @@ class Worker:
                         log(self.worker_id, "No jobs found. Sleeping...")
                         self.sleep_with_shutdown_check(5)
 
+                except (ConnectionError, TimeoutError, QueueClientError) as e:
+                    log(self.worker_id, f"Broker request failed: {e}. Retrying.")
+                    self.sleep_with_shutdown_check(5)
+
                 except (InterruptedError, OSError) as e:
                     log(
                         self.worker_id,
@@ -82,9 +652,11 @@ class Worker:
             log(self.worker_id, "KeyboardInterrupt received. Shutting down...")
 
         finally:
+            log(self.worker_id, f"Phase timings: {phases.summary()}")
             log(self.worker_id, "Run loop exiting. Closing database connection.")
-            close_conn()
+            self.queue.close()
 
+    @timed("idle")
     def sleep_with_shutdown_check(self, duration: int):
         for _ in range(duration):
             if self.shutdown_flag:
@@ -92,26 +664,33 @@ class Worker:
 
             time.sleep(1)
 
+    @timed("process")
     def process_job(self, job: model.Job):
+        # an identical job may have finished since this one was enqueued
+        if self.queue.complete_from_cache(job):
+            log(self.worker_id, f"Job {job.id} completed from cache.")
+            return
+
         try:
-            result = subprocess.run(
-                job.command,
-                shell=True,
-                check=True,
-                capture_output=True,
-                text=True,
-                timeout=60,
-            )
+            # payloads are only read here, never by the claim
+            payload = self.queue.load_payload(job)
+            default_timeout = self.config.get("job_timeout", DEFAULT_JOB_TIMEOUT)
+            item_results = None
 
-            log(self.worker_id, f"Job {job.id} completed.")
-            log(self.worker_id, f"Output: {result.stdout.strip()}")
-            queue_ctl.update_job_state(job.id, "completed", next_run_time=None)
+            if job.parent_id is None:
+                usage, stdout, stderr = run_job_command(job, default_timeout, payload)
 
-        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
-            error_output = e.stderr.strip() if hasattr(e, "stderr") else "Timed out"
-            log(self.worker_id, f"Job {job.id} failed.")
-            log(self.worker_id, f"Error: {error_output}")
-            self.handle_failure(job)
+            else:
+                # a retry only runs the inputs that failed or never ran
+                items = self.queue.load_map_items(job)
+                usage, stdout, stderr, item_results = run_map_chunk(
+                    job, default_timeout, payload, items
+                )
+                log(
+                    self.worker_id,
+                    f"Job {job.id} ran {len(item_results)}/{len(items)} map inputs, "
+                    f"{sum(code != 0 for code in item_results.values())} failed",
+                )
 
         except Exception as e:
             log(
@@ -121,29 +700,53 @@ class Worker:
 
             if self.shutdown_flag:
                 log(self.worker_id, "Interruption was due to shutdown. Re-queuing.")
-                queue_ctl.requeue_interrupted_job(job.id, job.attempts)
+                self.queue.requeue(job)
 
             else:
                 log(self.worker_id, "Interruption was not shutdown. Failing job.")
                 self.handle_failure(job)
 
-    def handle_failure(self, job: model.Job):
-        if job.attempts >= job.max_retries:
+            return
+
+        log(
+            self.worker_id,
+            f"Job {job.id} usage: exit={usage.exit_code} wall={usage.wall_time:.3f}s "
+            f"user={usage.utime:.3f}s sys={usage.stime:.3f}s maxrss={usage.maxrss}KB",
+        )
+
+        if usage.timed_out:
+            log(self.worker_id, f"Job {job.id} failed.")
+            log(self.worker_id, "Error: Timed out, process group killed")
+            self.handle_failure(job, usage, (stdout, stderr), item_results)
+
+        elif usage.exit_code != 0:
+            log(self.worker_id, f"Job {job.id} failed.")
+            log(self.worker_id, f"Error: {stderr.strip()}")
+            self.handle_failure(job, usage, (stdout, stderr), item_results)
+
+        else:
+            log(self.worker_id, f"Job {job.id} completed.")
+            log(self.worker_id, f"Output: {stdout.strip()}")
+            self.queue.complete(job, usage, (stdout, stderr), item_results)
+
+    def handle_failure(
+        self,
+        job: model.Job,
+        usage: model.RunUsage | None = None,
+        output: tuple[str, str] | None = None,
+        item_results: dict[int, int] | None = None,
+    ):
+        delay_seconds = self.queue.fail(job, usage, output, item_results)
+
+        if delay_seconds is None:
             log(
                 self.worker_id,
-                f"Job {job.id} has exceeded maximum retries. Moving to DLQ.",
+                f"Job {job.id} has exceeded maximum retries. Moved to DLQ.",
             )
-            queue_ctl.update_job_state(job.id, "dead", next_run_time=None)
 
         else:
-            base = self.config["backoff_base"]
-            delay_seconds = base**job.attempts
-
             retry_time = datetime.now(timezone.utc) + timedelta(seconds=delay_seconds)
             log(
                 self.worker_id,
                 f"Job {job.id} failed. Retrying in {delay_seconds}s (at {retry_time.isoformat()}).",
             )
-            queue_ctl.update_job_state(
-                job.id, "failed", next_run_time=retry_time.isoformat()
-            )